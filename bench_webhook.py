@@ -0,0 +1,161 @@
+"""
+Webhook ingest benchmark: native ASGI endpoint vs Flask-over-WsgiToAsgi.
+
+Drives both ASGI callables in-process (no sockets, no Hypercorn) with a
+realistic group-message update and reports requests/s plus p50/p99 ingest
+latency (request received -> update enqueued -> response sent).
+
+Usage:
+    python bench_webhook.py --requests 5000 --concurrency 50
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+os.environ.setdefault("TOKEN", "123456:BENCHMARK-TOKEN")
+os.environ.setdefault("WEBHOOK_SECRET", "bench-secret")
+
+import bot  # noqa: E402  (env must be set before import)
+
+try:
+    import orjson
+    _dumps = orjson.dumps
+except ImportError:
+    import json
+    _dumps = lambda obj: json.dumps(obj).encode("utf-8")
+
+
+def _sample_update(update_id: int) -> bytes:
+    return _dumps({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": -1001234567890, "type": "supergroup", "title": "Bench Group"},
+            "from": {"id": 424242, "is_bot": False, "first_name": "Bench"},
+            "text": "hello there, this is a fairly ordinary group message",
+            "entities": [{"type": "bold", "offset": 0, "length": 5}],
+        },
+    })
+
+
+def _scope(body: bytes) -> dict:
+    # Flask (via WsgiToAsgi) reads exactly content-length bytes; without it the body is empty
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "https",
+        "path": bot.WEBHOOK_PATH,
+        "raw_path": bot.WEBHOOK_PATH.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [
+            (b"host", b"bench.local"),
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"x-telegram-bot-api-secret-token", bot.WEBHOOK_SECRET.encode()),
+        ],
+        "client": ("127.0.0.1", 50000),
+        "server": ("127.0.0.1", 443),
+    }
+
+
+async def _one_request(asgi_app, body: bytes) -> tuple[float, int]:
+    sent_body = False
+    status = 0
+
+    async def receive():
+        nonlocal sent_body
+        if not sent_body:
+            sent_body = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await asyncio.sleep(3600)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    start = time.perf_counter()
+    await asgi_app(_scope(body), receive, send)
+    return time.perf_counter() - start, status
+
+
+async def _drain_queue(stop: asyncio.Event):
+    queue = bot.application.update_queue
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(queue.get(), timeout=0.1)
+            queue.task_done()
+        except asyncio.TimeoutError:
+            continue
+
+
+async def _run(name: str, asgi_app, total: int, concurrency: int) -> dict:
+    bodies = [_sample_update(i) for i in range(total)]
+    gate = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+    errors = 0
+
+    async def worker(body):
+        nonlocal errors
+        async with gate:
+            elapsed, status = await _one_request(asgi_app, body)
+            latencies.append(elapsed)
+            if status != 200:
+                errors += 1
+
+    stop = asyncio.Event()
+    drainer = asyncio.create_task(_drain_queue(stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(b) for b in bodies))
+    wall = time.perf_counter() - start
+    stop.set()
+    await drainer
+
+    latencies.sort()
+    return {
+        "name": name,
+        "rps": total / wall,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        "errors": errors,
+    }
+
+
+async def main(total: int, concurrency: int):
+    bot.MAIN_LOOP = asyncio.get_running_loop()
+    # Skip Application.initialize() (it calls getMe over the network); the ingest
+    # path only needs the running flag and the update queue.
+    bot.application._running = True
+
+    from asgiref.wsgi import WsgiToAsgi
+    results = [
+        await _run("native-asgi", bot.webhook_asgi_app, total, concurrency),
+        await _run("flask-wsgi", WsgiToAsgi(bot.app), total, concurrency),
+    ]
+
+    print(f"{'path':<14}{'req/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for r in results:
+        print(f"{r['name']:<14}{r['rps']:>12.0f}{r['p50_ms']:>10.3f}{r['p99_ms']:>10.3f}{r['errors']:>8}")
+
+    failed = [r["name"] for r in results if r["errors"]]
+    if failed:
+        # Error responses are cheap; figures that include them don't compare the two paths
+        print(f"FAILED: non-200 responses from {', '.join(failed)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.requests, args.concurrency)))
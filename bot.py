@@ -6,7 +6,12 @@ import html
 import joblib
 import time
 import random
-from datetime import datetime, timedelta, time as dt_time
+import copy
+import hashlib
+import contextvars
+from array import array
+from collections import deque, OrderedDict
+from datetime import datetime, timedelta, timezone
 from flask import Flask, request
 from unidecode import unidecode
 from telegram import (
@@ -14,20 +19,28 @@ from telegram import (
     ChatPermissions, Bot, Message, MessageEntity, User, ChatMember,
     MessageOriginChannel, MessageOriginChat, MessageOriginHiddenUser, ReactionTypeEmoji, Chat
 )
-from telegram.constants import ParseMode, ChatType, MessageEntityType
+from telegram.constants import ParseMode, ChatType, MessageEntityType, UpdateType
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler,
-    CallbackQueryHandler, ContextTypes, filters, Application
+    CallbackQueryHandler, ContextTypes, filters, Application, BaseUpdateProcessor,
+    ChatMemberHandler, BaseRateLimiter
 )
-from telegram.error import TelegramError, BadRequest
+from telegram.error import TelegramError, BadRequest, NetworkError, RetryAfter
 from urllib.parse import urlparse
 from typing import cast, Any, Optional
 from hypercorn.asyncio import serve
 from hypercorn.config import Config
 from asgiref.wsgi import WsgiToAsgi
 import feedparser
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:  # orjson is optional; fall back to the stdlib parser
+    import json
+    _json_loads = json.loads
 # Import our database module
 import database as db
+from metrics import LatencyHistogram
 
 # ================= Configuration =================
 TOKEN = os.getenv("TOKEN")
@@ -43,6 +56,11 @@ CHANNELS = list(CHANNEL_DATA.keys())
 JOIN_IMAGE = "https://raw.githubusercontent.com/hemanth-attr/mybot/main/thumbnail.jpg"
 FILE_PATH = "https://github.com/hemanth-attr/mybot/raw/main/as/Plus-UI-3.7.0-Updated.zip"
 STICKER_ID = "CAACAgUAAxkBAAE7GgABaMbdL0TUWT9EogNP92aPwhOpDHwAAkwXAAKAt9lUs_YoJCwR4mA2BA"
+# Uploaded once, then sent by file_id. asset -> (local copy, URL used if the local copy is missing)
+MEDIA_ASSETS = {
+    "gated_file": ("as/Plus-UI-3.7.0-Updated.zip", FILE_PATH),
+    "join_image": ("thumbnail.jpg", JOIN_IMAGE),
+}
 PORT = int(os.environ.get("PORT", 10000))
 
 SYSTEM_BOT_IDS = [136817688, 1087968824, 777000, 5400015595]
@@ -51,6 +69,151 @@ USERNAME_REQUIRED = False
 WEBHOOK_URL = os.getenv("WEBHOOK_URL") 
 WEBHOOK_PATH = "/botupdates"
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "a_very_strong_random_string_12345_replace_me")
+# "asgi" serves the webhook natively on the event loop; "flask" keeps the old Flask-over-WsgiToAsgi path
+WEBHOOK_SERVER = os.getenv("WEBHOOK_SERVER", "asgi").lower()
+WEBHOOK_MAX_BODY = 1024 * 1024  # Telegram updates are far smaller than this
+WEBHOOK_FLASK_TIMEOUT = 10      # Seconds the Flask view waits for the loop to enqueue an update
+
+# === Update Narrowing ===
+# Chat types we act on; anything else is dropped before Update.de_json.
+HANDLED_CHAT_TYPES = {"private", "group", "supergroup"}
+# Service messages no handler uses (join/left messages are NOT here: we delete those).
+IGNORED_SERVICE_KEYS = (
+    "new_chat_title", "new_chat_photo", "delete_chat_photo", "group_chat_created",
+    "supergroup_chat_created", "channel_chat_created", "message_auto_delete_timer_changed",
+    "migrate_to_chat_id", "migrate_from_chat_id", "pinned_message",
+    "video_chat_scheduled", "video_chat_started", "video_chat_ended", "video_chat_participants_invited",
+    "forum_topic_created", "forum_topic_edited", "forum_topic_closed", "forum_topic_reopened",
+    "general_forum_topic_hidden", "general_forum_topic_unhidden", "write_access_allowed",
+    "proximity_alert_triggered", "boost_added", "chat_background_set",
+    "giveaway_created", "giveaway_completed", "users_shared", "chat_shared",
+)
+
+# === Update De-duplication ===
+# Telegram redelivers updates it thinks we missed; remember this many update_ids.
+DEDUP_WINDOW = int(os.environ.get("DEDUP_WINDOW", 10000))
+# Persist the window across restarts (per bot) so a redeploy doesn't reprocess redeliveries.
+DEDUP_PERSIST = os.getenv("DEDUP_PERSIST", "false").lower() in ("1", "true", "yes")
+DEDUP_SAVE_INTERVAL = 30        # Seconds between snapshots when persisting
+
+# === Ingest Backpressure ===
+# Max updates accepted but not yet fully processed; 0 disables the bound.
+UPDATE_QUEUE_MAX = int(os.environ.get("UPDATE_QUEUE_MAX", 2000))
+# Status returned when saturated so Telegram redelivers later (429 or 503).
+UPDATE_QUEUE_SHED_STATUS = int(os.environ.get("UPDATE_QUEUE_SHED_STATUS", 503))
+# Degraded mode (moderation only) starts at ENTER * max and ends at EXIT * max.
+DEGRADED_ENTER_RATIO = float(os.environ.get("DEGRADED_ENTER_RATIO", 0.5))
+DEGRADED_EXIT_RATIO = float(os.environ.get("DEGRADED_EXIT_RATIO", 0.1))
+
+# === Update Deadline / Fail-open ===
+# DB work for one message must finish within this many seconds (0 = no deadline).
+# Past it, or while the DB breaker is open, moderation continues rule-only from memory.
+UPDATE_DEADLINE = float(os.environ.get("UPDATE_DEADLINE", 3))
+
+# === Admin Cache ===
+# chat_member events keep the cache current; the TTL is only a safety net.
+ADMIN_CACHE_TTL = int(os.environ.get("ADMIN_CACHE_TTL", 6 * 3600))
+ADMIN_REFRESH_ATTEMPTS = 3      # Refetches when admin changes land while a refresh is in flight
+ADMIN_STATUSES = {ChatMember.ADMINISTRATOR, ChatMember.OWNER}
+
+# === Telegram Lookup Cache (seconds) ===
+LOOKUP_CHAT_TTL = int(os.environ.get("LOOKUP_CHAT_TTL", 3600))      # @username -> chat
+LOOKUP_MEMBER_TTL = int(os.environ.get("LOOKUP_MEMBER_TTL", 300))   # (chat, user) -> member status
+LOOKUP_NEGATIVE_TTL = int(os.environ.get("LOOKUP_NEGATIVE_TTL", 60)) # Failed lookups (not found, no access)
+LOOKUP_MAX_ENTRIES = 50000
+
+# === Join Gate ===
+JOIN_VERIFIED_TTL = int(os.environ.get("JOIN_VERIFIED_TTL", 600)) # Verified users skip the channel checks
+JOIN_CLICK_DEBOUNCE = 30 # Repeat "Done" clicks after a success are answered from cache (seconds)
+JOIN_RETRY_DEBOUNCE = 3  # ...and after a failure, so a user who just joined can retry quickly
+MEMBER_STATUSES = {"member", "administrator", "creator", "restricted"}
+
+# === Announcement Scheduler ===
+# Runs missed while the bot was down: "once" sends one catch-up post shortly
+# after startup, "skip" moves straight on to the next future run.
+ANNOUNCEMENT_CATCHUP = os.getenv("ANNOUNCEMENT_CATCHUP", "once").lower()
+ANNOUNCEMENT_CATCHUP_DELAY = 10 # Seconds after startup for catch-up posts
+ANNOUNCEMENT_RESTORE_PAGE = 500 # Rows per page when restoring jobs
+
+# === Activity Leaderboard ===
+LEADERBOARD_CACHE_SIZE = 25 # Top-K kept in memory per chat (/top shows the first 10)
+
+# === Outbound Rate Limits (Telegram Bot API) ===
+RATE_GLOBAL_PER_SEC = 30        # All requests
+RATE_GROUP_PER_MIN = 20         # Messages sent into one group/channel
+RATE_PRIVATE_PER_SEC = 1        # Messages sent into one private chat
+RATE_MAX_RETRIES = 2            # Retries after a RetryAfter (flood wait)
+# Priority classes, passed per call as rate_limit_args=...
+PRIORITY_MODERATION = 0         # Deletes, restrictions, warnings
+PRIORITY_INTERACTIVE = 1        # Replies to users and admins (default)
+PRIORITY_BULK = 2               # Announcements, broadcasts, RSS
+PRIORITY_NAMES = ("moderation", "interactive", "bulk")
+DELETE_BATCH_MAX = 100          # deleteMessages accepts at most 100 ids per call
+
+# === Bulk Link Commands (/del, /pin, /react, /unreact, /edit, /replyto) ===
+BULK_LINK_MAX = 500             # Links processed per command
+BULK_LINK_CONCURRENCY = 8       # API calls in flight per command
+BULK_LINK_FILE_MAX = 1024 * 1024
+
+# === Raid Notice Coalescing ===
+# Above THRESHOLD moderation notices per WINDOW seconds in one chat, notices are
+# buffered for FLUSH_DELAY seconds and posted as a single (edited) summary.
+NOTICE_RAID_THRESHOLD = int(os.environ.get("NOTICE_RAID_THRESHOLD", 5))
+NOTICE_RATE_WINDOW = 10
+NOTICE_FLUSH_DELAY = 3
+NOTICE_SUMMARY_MAX = 20         # Entries per summary message (each brings one button)
+NOTICE_SUMMARY_EDIT_WINDOW = 120 # Seconds a summary keeps absorbing new entries
+NOTICE_SUMMARY_NOTES = 10       # Resolution notes kept on a summary (older ones are counted)
+NOTICE_TEXT_MAX = 4096          # Telegram message text limit
+
+# === Join Raid Lockdown ===
+# JOIN_RAID_THRESHOLD joins within JOIN_RAID_WINDOW seconds put a chat into lockdown:
+# new joiners are muted until it ends, then released JOIN_LIFT_BATCH at a time.
+JOIN_RAID_THRESHOLD = int(os.environ.get("JOIN_RAID_THRESHOLD", 20))
+JOIN_RAID_WINDOW = 60
+JOIN_RAID_BUCKET = 5            # Window resolution (seconds per counter)
+JOIN_LOCKDOWN_SECONDS = int(os.environ.get("JOIN_LOCKDOWN_SECONDS", 600)) # Extended while the raid continues
+JOIN_RESTRICT_CONCURRENCY = 10
+JOIN_LIFT_BATCH = 25
+JOIN_LIFT_INTERVAL = 30
+JOIN_LOCKDOWN_MAX_TRACKED = 50000 # Beyond this, restrictions simply expire on their own
+JOIN_QUEUE_MAX = 5000           # Joiners waiting to be muted; past this they're counted and admins warned
+JOIN_RESTRICT_GRACE = 3600      # Restrictions carry until_date = lockdown end + grace, in case we never lift them
+
+# === Shared Spammer Blocklist ===
+# Users banned or muted 3/3 in any of our chats; chats opt in with /set_blocklist on.
+BLOCKLIST_REFRESH_INTERVAL = 60 # Seconds between incremental reloads (full reload hourly)
+BLOCKLIST_MUTE_DAYS = 7         # Listed users are muted this long when they show up in an opted-in chat
+
+# === Edited Message Checks ===
+VERDICT_CACHE_SIZE = 5000       # Recently checked messages remembered (LRU)
+EDIT_DEBOUNCE = 1.5             # Seconds of quiet before an edited message is re-checked
+
+# === Repeated Media Flood ===
+# The same photo/sticker/GIF/video/document (by file_unique_id) posted by this many
+# different users within the window, in one chat or across all chats, is treated as
+# spam. Stickers only count per chat: popular ones legitimately show up everywhere.
+MEDIA_FLOOD_WINDOW = int(os.environ.get("MEDIA_FLOOD_WINDOW", 300))
+MEDIA_FLOOD_CHAT_THRESHOLD = int(os.environ.get("MEDIA_FLOOD_CHAT_THRESHOLD", 8))
+MEDIA_FLOOD_GLOBAL_THRESHOLD = int(os.environ.get("MEDIA_FLOOD_GLOBAL_THRESHOLD", 25))
+MEDIA_FLOOD_MAX_ENTRIES = 100000 # Items per generation per index (~40 bytes each, ~8 MB preallocated per index); a full generation rotates early
+
+# === Recent Messages / Purge ===
+RECENT_RING_SIZE = int(os.environ.get("RECENT_RING_SIZE", 1000))            # Messages remembered per chat
+PURGE_MAX_COUNT = int(os.environ.get("PURGE_MAX_COUNT", 500))               # /purge N upper bound
+SANCTION_PURGE_MINUTES = int(os.environ.get("SANCTION_PURGE_MINUTES", 60))  # Cleanup window on ban/mute (0 = off)
+DELETE_MAX_AGE = 48 * 3600      # Bots cannot delete group messages older than 48h
+
+# === Message Author Index (link -> author without the forward trick) ===
+AUTHOR_INDEX_RETENTION_HOURS = int(os.environ.get("AUTHOR_INDEX_RETENTION_HOURS", 72))
+AUTHOR_FLUSH_BATCH = 200        # Rows per INSERT
+AUTHOR_FLUSH_INTERVAL = 5       # Seconds between background flushes
+AUTHOR_BUFFER_MAX = 20000       # Unflushed rows kept while the DB is unavailable
+
+# === Update Processing ===
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", 64)) # Global cap on in-flight updates
+# "chat": one update at a time per chat. "chat_user": one at a time per (chat, user).
+UPDATE_ORDERING = os.getenv("UPDATE_ORDERING", "chat").lower()
 
 # === URL Blocking Control ===
 BLOCK_ALL_URLS = False
@@ -86,8 +249,17 @@ ML_MODEL = None
 TFIDF_VECTORIZER = None
 user_behavior = {} # In-memory flood control cache
 rep_cooldowns = {}
+MAIN_LOOP: Optional[asyncio.AbstractEventLoop] = None # Set once the server starts (used by the Flask compat path)
+ALLOWED_UPDATES = frozenset(Update.ALL_TYPES) # Narrowed to the registered handlers in setup_bot_application()
+ingest_stats = {"received": 0, "prefiltered": 0}
+admin_cache: dict[int, tuple[list[int], float]] = {} # chat_id -> (admin_ids, expires_at)
+admin_versions: dict[int, int] = {} # chat_id -> bumped per chat_member admin change; refreshes check it
+join_verified: dict[int, float] = {} # user_id -> verified_until (member of all CHANNELS)
+join_clicks: dict[int, tuple[float, bool]] = {} # user_id -> (last "Done" click, result)
+fallback_warnings: dict[tuple[int, int], tuple[int, datetime]] = {} # (chat, user) -> (count, expiry) while the DB is down
 # Add this here:
 URL_FINDER_REGEX = re.compile(r'((?:https?://|www\.|t\.me/)\S+|[a-zA-Z0-9-]+\.[a-zA-Z]{2,}\S*)', re.I)
+MESSAGE_LINK_REGEX = re.compile(r"(?:https?://)?(?:www\.)?t\.me/(?:c/)?(\d+|[\w\d_]+)/(\d+)")
 
 # ================= Logging =================
 logging.basicConfig(
@@ -96,6 +268,27 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ================= Concurrency Helpers =================
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into one in-flight task."""
+    def __init__(self):
+        self._inflight: dict[Any, asyncio.Future] = {}
+
+    async def do(self, key, factory):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _t: self._inflight.pop(key, None))
+        # Shield so one caller being cancelled doesn't cancel the call for everyone else
+        return await asyncio.shield(task)
+
+    def __len__(self):
+        return len(self._inflight)
+
+admin_refreshes = SingleFlight()
+
 # ================= Data Management =================
 def _load_ml_model_sync(vectorizer_path, model_path):
     """Synchronous ML model loading helper."""
@@ -103,6 +296,92 @@ def _load_ml_model_sync(vectorizer_path, model_path):
     model = joblib.load(model_path)
     return vectorizer, model
 
+# ================= Media Registry =================
+
+def _hash_media_source(path: str, url: str) -> str:
+    """Version of an asset: sha256 of the local file, or of the URL when there is none."""
+    if os.path.isfile(path):
+        with open(path, "rb") as fh:
+            return hashlib.sha256(fh.read()).hexdigest()
+    return "url:" + hashlib.sha256(url.encode()).hexdigest()
+
+def _extract_file_id(message: Message) -> Optional[str]:
+    if message.photo:
+        return message.photo[-1].file_id
+    media = message.document or message.animation or message.video or message.sticker or message.audio
+    return media.file_id if media else None
+
+class MediaRegistry:
+    """
+    Uploads each asset once and reuses Telegram's file_id afterwards, so
+    sends need no external fetch. The content hash is the version: a changed
+    file gets a new hash and is re-uploaded on the next send.
+    """
+    def __init__(self, assets: dict[str, tuple[str, str]]):
+        self.assets = assets
+        self._versions: dict[str, str] = {}
+        self._file_ids: dict[str, str] = {}
+        self._uploads: dict[str, asyncio.Future] = {}
+
+    async def load(self):
+        """Hashes the assets and loads file_ids stored for the same version (run at startup)."""
+        for asset, (path, url) in self.assets.items():
+            version = await asyncio.to_thread(_hash_media_source, path, url)
+            self._versions[asset] = version
+            stored_hash, file_id = await db.get_media_file(asset)
+            if file_id and stored_hash == version:
+                self._file_ids[asset] = file_id
+            elif file_id:
+                logger.info(f"Media asset '{asset}' changed; it will be re-uploaded on next send.")
+
+    async def send(self, asset: str, send_func, media_arg: str, **kwargs) -> Message:
+        """
+        Sends an asset with a bound send method, e.g.
+        send("gated_file", bot.send_document, "document", chat_id=...).
+        """
+        for _ in range(2):
+            file_id = self._file_ids.get(asset)
+            if file_id:
+                try:
+                    return await send_func(**{media_arg: file_id}, **kwargs)
+                except BadRequest as e:
+                    logger.warning(f"Stored file_id for '{asset}' was rejected ({e}); re-uploading.")
+                    if self._file_ids.get(asset) == file_id:
+                        del self._file_ids[asset]
+                    continue
+
+            pending = self._uploads.get(asset)
+            if pending:
+                # Another send is uploading this asset; wait and reuse its file_id
+                await asyncio.shield(pending)
+                continue
+            return await self._upload(asset, send_func, media_arg, kwargs)
+        return await self._upload(asset, send_func, media_arg, kwargs)
+
+    async def _upload(self, asset: str, send_func, media_arg: str, kwargs: dict) -> Message:
+        path, url = self.assets[asset]
+        done = asyncio.get_running_loop().create_future()
+        self._uploads[asset] = done
+        try:
+            if os.path.isfile(path):
+                with open(path, "rb") as fh:
+                    message = await send_func(**{media_arg: fh}, **kwargs)
+            else:
+                message = await send_func(**{media_arg: url}, **kwargs)
+        finally:
+            self._uploads.pop(asset, None)
+            done.set_result(None)
+
+        file_id = _extract_file_id(message)
+        if file_id:
+            self._file_ids[asset] = file_id
+            version = self._versions.get(asset) or await asyncio.to_thread(_hash_media_source, path, url)
+            await db.save_media_file(asset, version, file_id)
+            logger.info(f"Uploaded media asset '{asset}'; file_id stored.")
+        return message
+
+media_registry = MediaRegistry(MEDIA_ASSETS)
+
 # ================= Advanced Behavioral Analysis/ Global Functions =================
 def get_rank_string(msg_count: int) -> str:
     if msg_count < 10: return "Newbie 👶"
@@ -137,10 +416,33 @@ async def check_rss_feeds(context: ContextTypes.DEFAULT_TYPE):
                 link = entry.link
                 msg = f"📰 <b>New Post!</b>\n\n<b>{title}</b>\n\n👇 Read here:\n{link}"
                 
-                await context.bot.send_message(chat_id=feed['target_chat_id'], text=msg, parse_mode=ParseMode.HTML)
+                await context.bot.send_message(chat_id=feed['target_chat_id'], text=msg, parse_mode=ParseMode.HTML, rate_limit_args=PRIORITY_BULK)
                 await db.update_rss_last_entry(feed['id'], entry_id)
         except Exception as e:
             logger.error(f"RSS Error: {e}")
+async def noncritical_write(write):
+    """Awaits a best-effort DB write (stats, counters), skipping it while the database is degraded."""
+    if db.breaker.degraded:
+        write.close()
+        return None
+    try:
+        return await write
+    except db.DatabaseUnavailable:
+        return None
+
+async def add_warning_failopen(chat_id: int, user_id: int) -> tuple[int, datetime]:
+    """db.add_warning_async, falling back to in-memory counts while the database is unavailable."""
+    try:
+        return await db.add_warning_async(chat_id, user_id)
+    except db.DatabaseUnavailable:
+        now = datetime.now(timezone.utc)
+        count, expiry = fallback_warnings.get((chat_id, user_id), (0, now))
+        count = 1 if expiry < now else count + 1
+        expiry = now + timedelta(days=1)
+        fallback_warnings[(chat_id, user_id)] = (count, expiry)
+        logger.warning(f"DB unavailable; warning {count}/3 for {user_id} in {chat_id} kept in memory.")
+        return count, expiry
+
 async def update_user_activity(chat_id: int, user_id: int):
     """Updates in-memory flood cache and persistent DB new-user count."""
     user_id_str = str(user_id)
@@ -152,7 +454,7 @@ async def update_user_activity(chat_id: int, user_id: int):
     activity["messages"].append(now)
     
     # 2. Persistent initial message count (call the DB)
-    await db.increment_user_initial_count(chat_id, user_id, MAX_INITIAL_MESSAGES)
+    await noncritical_write(db.increment_user_initial_count(chat_id, user_id, MAX_INITIAL_MESSAGES))
 
 def is_flood_spam(user_id: int) -> bool:
     """Checks flood status based on current in-memory data."""
@@ -164,7 +466,10 @@ async def is_first_message_critical(chat_id: int, user_id: int, strict_mode_enab
     """Checks if a user is a new user under strict mode, using the database."""
     if not strict_mode_enabled:
         return False
-    initial_count = await db.get_user_initial_count(chat_id, user_id)
+    try:
+        initial_count = await db.get_user_initial_count(chat_id, user_id)
+    except db.DatabaseUnavailable:
+        return False # Fail open: without the count, fall back to the normal rules
     return initial_count < MAX_INITIAL_MESSAGES
 
 
@@ -276,31 +581,153 @@ async def is_spam(message: Message, message_text: str, message_entities: list[Me
 
 # ================= Bot Helper Functions =================
 
-async def get_admin_ids(chat: Chat, context: ContextTypes.DEFAULT_TYPE) -> list[int]:
+class TelegramLookupCache:
     """
-    Gets admin IDs from cache or refreshes cache if expired (1-hour TTL).
+    Read-through cache for Bot API lookups: per-fact TTLs, concurrent
+    identical lookups share one call, and failures (not found, no access)
+    are cached briefly too. Transient network errors are never cached.
     """
-    admin_ids = context.chat_data.get("admin_ids")
-    cache_expiry = context.chat_data.get("admin_cache_expiry", 0)
-    now = time.time()
-
-    if not admin_ids or now > cache_expiry:
+    def __init__(self, ttls: dict[str, float], negative_ttl: float, max_entries: int):
+        self.ttls = ttls
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries: dict[tuple, tuple[float, Any, Optional[TelegramError]]] = {} # key -> (expires, value, error)
+        self._flights = SingleFlight()
+        self.stats = {kind: {"hit": 0, "miss": 0, "negative": 0} for kind in ttls}
+
+    async def get_chat(self, bot: Bot, chat_id) -> Chat:
+        return await self._lookup("chat", (chat_id,), lambda: bot.get_chat(chat_id))
+
+    async def get_chat_member(self, bot: Bot, chat_id, user_id: int) -> ChatMember:
+        if not isinstance(chat_id, int):
+            # "@username" from links: key on the numeric id so chat_member events (put_member) invalidate it
+            chat_id = (await self.get_chat(bot, chat_id)).id
+        return await self._lookup("member", (chat_id, user_id), lambda: bot.get_chat_member(chat_id, user_id))
+
+    def put_member(self, chat_id: int, member: ChatMember):
+        """Stores a member we learned about from an update (e.g. chat_member events)."""
+        self._store(("member", chat_id, member.user.id), member, None, self.ttls["member"])
+
+    async def _lookup(self, kind: str, key: tuple, factory):
+        full_key = (kind,) + key
+        stats = self.stats[kind]
+        entry = self._entries.get(full_key)
+        if entry and entry[0] > time.monotonic():
+            if entry[2] is not None:
+                stats["negative"] += 1
+                raise copy.copy(entry[2]) # Fresh instance, so the cached one's traceback doesn't keep growing
+            stats["hit"] += 1
+            return entry[1]
+        stats["miss"] += 1
+        return await self._flights.do(full_key, lambda: self._fetch(kind, full_key, factory))
+
+    async def _fetch(self, kind: str, full_key: tuple, factory):
         try:
-            logger.info(f"Refreshing admin cache for chat {chat.id}...")
-            chat_admins = await chat.get_administrators()
-            admin_ids = [admin.user.id for admin in chat_admins]
-            
-            context.chat_data["admin_ids"] = admin_ids
-            context.chat_data["admin_cache_expiry"] = now + 3600  # Cache for 1 hour
+            value = await factory()
+        except (NetworkError, RetryAfter):
+            raise
         except TelegramError as e:
-            logger.error(f"Failed to refresh admin cache for {chat.id}: {e}")
-            admin_ids = admin_ids or [] # Use old list if update fails
-            
-    return admin_ids or []
+            self._store(full_key, None, copy.copy(e), self.negative_ttl)
+            raise
+        self._store(full_key, value, None, self.ttls[kind])
+        return value
+
+    def _store(self, full_key: tuple, value, error, ttl: float):
+        if len(self._entries) >= self.max_entries:
+            self.prune()
+        self._entries.pop(full_key, None) # Re-insert so dict order stays oldest-first
+        self._entries[full_key] = (time.monotonic() + ttl, value, error)
+
+    def prune(self):
+        """Drops expired entries; if still over capacity, drops the oldest tenth."""
+        now = time.monotonic()
+        for key in [k for k, v in self._entries.items() if v[0] <= now]:
+            del self._entries[key]
+        if len(self._entries) >= self.max_entries:
+            for key in list(self._entries)[:self.max_entries // 10]:
+                del self._entries[key]
+
+    def stats_lines(self) -> list[str]:
+        lines = [f"Entries: {len(self._entries)} | In flight: {len(self._flights)}"]
+        for kind, s in self.stats.items():
+            total = s["hit"] + s["negative"] + s["miss"]
+            rate = (s["hit"] + s["negative"]) / total * 100 if total else 0
+            lines.append(f"• {kind}: {rate:.1f}% hit ({s['hit']} hit, {s['negative']} negative, {s['miss']} miss)")
+        return lines
+
+tg_lookup = TelegramLookupCache(
+    {"chat": LOOKUP_CHAT_TTL, "member": LOOKUP_MEMBER_TTL}, LOOKUP_NEGATIVE_TTL, LOOKUP_MAX_ENTRIES
+)
+
+async def _load_admin_ids(chat: Chat) -> list[int]:
+    """
+    Fills the admin cache from the DB copy if it is fresh, otherwise from Telegram.
+    A snapshot read while a chat_member change arrived may predate it, so it is
+    only stored if admin_versions didn't move during the read; otherwise refetch.
+    """
+    now = time.time()
+    if chat.id not in admin_cache:
+        version = admin_versions.get(chat.id, 0)
+        try:
+            admin_ids, refreshed_at = await db.get_chat_admins(chat.id)
+        except db.DatabaseUnavailable:
+            admin_ids, refreshed_at = None, None
+        if admin_ids is not None and refreshed_at and admin_versions.get(chat.id, 0) == version:
+            expires_at = refreshed_at.timestamp() + ADMIN_CACHE_TTL
+            if now < expires_at:
+                admin_cache[chat.id] = (admin_ids, expires_at)
+                return admin_ids
+
+    logger.info(f"Refreshing admin cache for chat {chat.id}...")
+    for _ in range(ADMIN_REFRESH_ATTEMPTS):
+        version = admin_versions.get(chat.id, 0)
+        chat_admins = await chat.get_administrators()
+        admin_ids = [admin.user.id for admin in chat_admins]
+        if admin_versions.get(chat.id, 0) == version:
+            break
+        logger.info(f"Admin change in {chat.id} during refresh, refetching.")
+    # After the last attempt the fetch is still the freshest snapshot we have
+    admin_cache[chat.id] = (admin_ids, time.time() + ADMIN_CACHE_TTL)
+    await noncritical_write(db.save_chat_admins(chat.id, admin_ids))
+    return admin_ids
+
+async def get_admin_ids(chat: Chat, context: ContextTypes.DEFAULT_TYPE) -> list[int]:
+    """
+    Gets admin IDs from the cache. chat_member events keep it current; on a
+    miss or expiry one refresh per chat runs and concurrent callers share it.
+    """
+    cached = admin_cache.get(chat.id)
+    if cached and time.time() < cached[1]:
+        return cached[0]
+
+    try:
+        return await admin_refreshes.do(chat.id, lambda: _load_admin_ids(chat))
+    except TelegramError as e:
+        logger.error(f"Failed to refresh admin cache for {chat.id}: {e}")
+        return cached[0] if cached else [] # Use old list if update fails
+
+async def apply_admin_change(chat_id: int, user_id: int, now_admin: bool):
+    """Applies a promotion/demotion from a chat_member event to the cache."""
+    admin_versions[chat_id] = admin_versions.get(chat_id, 0) + 1 # Any refresh in flight now refetches
+    cached = admin_cache.get(chat_id)
+    if not cached:
+        # Nothing in memory to patch; drop the DB copy so the next lookup refetches.
+        await db.clear_chat_admins(chat_id)
+        return
+    admin_ids, expires_at = cached
+    if now_admin and user_id not in admin_ids:
+        admin_ids = admin_ids + [user_id]
+    elif not now_admin and user_id in admin_ids:
+        admin_ids = [a for a in admin_ids if a != user_id]
+    else:
+        return
+    admin_cache[chat_id] = (admin_ids, expires_at)
+    await db.save_chat_admins(chat_id, admin_ids, refreshed=False)
+    logger.info(f"Admin cache for {chat_id}: user {user_id} {'promoted' if now_admin else 'demoted'}.")
 
 async def is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """
-    Checks if the user sending the message is an admin, using a 1-hour cache.
+    Checks if the user sending the message is an admin, using the admin cache.
     """
     if not update.effective_chat or not update.effective_user:
         return False
@@ -344,7 +771,7 @@ async def get_target_user_id(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if user_id:
         try:
             if not target_user:
-                target_member = await context.bot.get_chat_member(message.chat_id, user_id)
+                target_member = await tg_lookup.get_chat_member(context.bot, message.chat_id, user_id)
                 target_user = target_member.user
             user_display = f"<a href='tg://user?id={user_id}'>{html.escape(target_user.first_name)}</a>"
             return user_id, user_display
@@ -408,20 +835,116 @@ async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     sent_count = 0
     for admin_id in admin_ids:
         try:
-            await context.bot.send_message(chat_id=admin_id, text=report_text, parse_mode=ParseMode.HTML, reply_markup=markup)
+            await context.bot.send_message(chat_id=admin_id, text=report_text, parse_mode=ParseMode.HTML, reply_markup=markup, rate_limit_args=PRIORITY_INTERACTIVE)
             sent_count += 1
         except Exception: pass
 
     await status_msg.edit_text(f"✅ Reported to {sent_count} admins.")
 
 # --- NEW: SCHEDULER (/ntf) ---
+def _parse_interval(time_val: str) -> int:
+    """'30m' / '2h' -> seconds."""
+    unit = time_val[-1].lower()
+    val = int(time_val[:-1])
+    return val * 60 if unit == 'm' else val * 3600
+
+def next_announcement_run(type_: str, time_val: str, after: datetime) -> datetime:
+    """First run strictly after `after` (UTC): next HH:MM for daily, after + interval otherwise."""
+    if type_ == "daily":
+        h, m = map(int, time_val.split(':'))
+        run = after.replace(hour=h, minute=m, second=0, microsecond=0)
+        return run if run > after else run + timedelta(days=1)
+    if type_ in ("every", "once"):
+        return after + timedelta(seconds=_parse_interval(time_val))
+    raise ValueError(f"Unknown schedule type '{type_}'")
+
+def _next_future_run(type_: str, time_val: str, due: datetime, now: datetime) -> datetime:
+    """Next run after `due` that is in the future, keeping 'every' on its original cadence."""
+    if type_ == "every":
+        interval = _parse_interval(time_val)
+        missed = int((now - due).total_seconds() // interval) + 1 if now >= due else 1
+        return due + timedelta(seconds=interval * missed)
+    return next_announcement_run(type_, time_val, max(due, now))
+
+def _schedule_announcement_job(job_queue, ann_id: int, chat_id: int, text: str, type_: str, time_val: str, run_at: datetime):
+    """Every announcement is a one-shot job at an absolute time; it re-arms itself after running."""
+    job_queue.run_once(
+        execute_announcement, when=run_at, chat_id=chat_id, name=f"ann_{ann_id}",
+        data={"id": ann_id, "text": text, "type": type_, "time_val": time_val, "due": run_at}
+    )
+
 async def execute_announcement(context: ContextTypes.DEFAULT_TYPE):
     job = context.job
+    ann = job.data
+
+    # Persist the next run before sending: a crash in between skips one post instead of repeating it
+    next_run = None
     try:
-        await context.bot.send_message(chat_id=job.chat_id, text=job.data)
+        if ann["type"] == "once":
+            await db.remove_announcement(ann["id"])
+        else:
+            next_run = _next_future_run(ann["type"], ann["time_val"], ann["due"], datetime.now(timezone.utc))
+            if not await db.set_announcement_next_run(ann["id"], next_run):
+                return # Removed while this run was pending
+    except db.DatabaseUnavailable as e:
+        # Can't tell whether it was removed; keep the schedule alive in memory, restore re-syncs it later
+        logger.warning(f"DB unavailable persisting announcement {ann['id']}, keeping in-memory schedule: {e}")
+    except Exception as e:
+        logger.error(f"Failed to persist schedule for announcement {ann['id']}: {e}")
+
+    try:
+        await context.bot.send_message(chat_id=job.chat_id, text=ann["text"], rate_limit_args=PRIORITY_BULK)
     except Exception as e:
         logger.error(f"Failed to send announcement: {e}")
 
+    if next_run:
+        _schedule_announcement_job(context.job_queue, ann["id"], job.chat_id, ann["text"], ann["type"], ann["time_val"], next_run)
+
+def _legacy_next_run(row, now: datetime) -> Optional[datetime]:
+    """next_run_at for rows saved before it existed; None for a 'once' that already fired."""
+    if row['type'] == "once":
+        due = next_announcement_run("once", row['time_val'], row['last_run'] or now)
+        return due if due > now else None
+    if row['type'] == "every":
+        return _next_future_run("every", row['time_val'], row['last_run'] or now, now)
+    return next_announcement_run(row['type'], row['time_val'], now)
+
+async def restore_announcements(job_queue):
+    """Re-arms saved announcements at their absolute next_run_at, reading the table in pages."""
+    now = datetime.now(timezone.utc)
+    after_id = 0
+    restored = caught_up = 0
+    while True:
+        rows = await db.get_announcements_page(after_id, ANNOUNCEMENT_RESTORE_PAGE)
+        for row in rows:
+            after_id = row['id']
+            try:
+                due = row['next_run_at']
+                if due is None:
+                    due = _legacy_next_run(row, now)
+                    if due is None:
+                        await db.remove_announcement(row['id'])
+                        continue
+                    await db.set_announcement_next_run(row['id'], due, ran=False)
+                elif due <= now:
+                    # Missed while we were down
+                    if ANNOUNCEMENT_CATCHUP == "once":
+                        due = now + timedelta(seconds=ANNOUNCEMENT_CATCHUP_DELAY)
+                        caught_up += 1
+                    elif row['type'] == "once":
+                        await db.remove_announcement(row['id'])
+                        continue
+                    else:
+                        due = _next_future_run(row['type'], row['time_val'], due, now)
+                        await db.set_announcement_next_run(row['id'], due, ran=False)
+                _schedule_announcement_job(job_queue, row['id'], row['chat_id'], row['text'], row['type'], row['time_val'], due)
+                restored += 1
+            except Exception as e:
+                logger.warning(f"Skipping announcement {row['id']}: {e}")
+        if len(rows) < ANNOUNCEMENT_RESTORE_PAGE:
+            break
+    logger.info(f"Restored {restored} announcements ({caught_up} catch-up runs, policy '{ANNOUNCEMENT_CATCHUP}').")
+
 async def ntf_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 1. Define variables immediately
     chat = update.effective_chat
@@ -444,19 +967,19 @@ async def ntf_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # --- LIST / REMOVE ---
     if args and args[0].lower() == "list":
-        rows = await db.get_all_announcements()
         # In private, show ALL. In group, show group's only.
         if chat.type == ChatType.PRIVATE:
-            display_rows = rows
+            display_rows = await db.get_all_announcements()
         else:
-            display_rows = [r for r in rows if r['chat_id'] == chat_id]
+            display_rows = await db.get_chat_announcements(chat_id)
             
         if not display_rows:
             await update.message.reply_text("No active announcements found.")
             return
         text = "📅 **Active Schedules:**\n"
         for r in display_rows:
-            text += f"ID `{r['id']}` | Chat `{r['chat_id']}` | {r['type']} {r['time_val']} | {r['text'][:15]}...\n"
+            next_run = f" | next {r['next_run_at']:%d/%m %H:%M} UTC" if r['next_run_at'] else ""
+            text += f"ID `{r['id']}` | Chat `{r['chat_id']}` | {r['type']} {r['time_val']}{next_run} | {r['text'][:15]}...\n"
         await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
         return
 
@@ -528,20 +1051,13 @@ async def ntf_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # --- HELPER TO EXECUTE SCHEDULE ---
 async def schedule_announcement(target_chat_id, sub_cmd, time_val, msg_text, context, reply_msg=None):
     try:
-        ann_id = await db.add_announcement(target_chat_id, msg_text, sub_cmd, time_val)
-        
-        # Schedule logic
-        if sub_cmd == "daily":
-            h, m = map(int, time_val.split(':'))
-            context.job_queue.run_daily(execute_announcement, dt_time(hour=h, minute=m), chat_id=target_chat_id, data=msg_text, name=f"ann_{ann_id}")
-        elif sub_cmd in ["every", "once"]:
-            unit = time_val[-1].lower()
-            val = int(time_val[:-1])
-            secs = val * 60 if unit == 'm' else val * 3600
-            if sub_cmd == "every":
-                context.job_queue.run_repeating(execute_announcement, interval=secs, first=10, chat_id=target_chat_id, data=msg_text, name=f"ann_{ann_id}")
-            else:
-                context.job_queue.run_once(execute_announcement, when=secs, chat_id=target_chat_id, data=msg_text, name=f"ann_{ann_id}")
+        now = datetime.now(timezone.utc)
+        # 'every' posts its first run shortly after creation, then on the interval
+        first_run = now + timedelta(seconds=10) if sub_cmd == "every" else next_announcement_run(sub_cmd, time_val, now)
+        ann_id = await db.add_announcement(target_chat_id, msg_text, sub_cmd, time_val, first_run)
+        if ann_id < 0:
+            raise RuntimeError("database unavailable")
+        _schedule_announcement_job(context.job_queue, ann_id, target_chat_id, msg_text, sub_cmd, time_val, first_run)
         
         result_text = f"✅ Scheduled for `{target_chat_id}` (ID: `{ann_id}`)"
         if reply_msg:
@@ -562,10 +1078,15 @@ async def get_user_from_link(context: ContextTypes.DEFAULT_TYPE, link: str):
     
     if isinstance(chat_id, str):
         try:
-            chat_obj = await context.bot.get_chat(chat_id)
+            chat_obj = await tg_lookup.get_chat(context.bot, chat_id)
             chat_id = chat_obj.id
         except Exception: return None, None, "Could not resolve Chat Username"
 
+    # Indexed authors resolve with one lookup and no API calls
+    indexed_user = await author_index.lookup(chat_id, message_id)
+    if indexed_user:
+        return chat_id, indexed_user, None
+
     try:
         # Forward to Private Chat
         dummy = await context.bot.forward_message(
@@ -640,7 +1161,7 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # 4. Get Target Display Name & Status
     try:
-        member = await context.bot.get_chat_member(chat.id, target_id)
+        member = await tg_lookup.get_chat_member(context.bot, chat.id, target_id)
         status = member.status.title() 
         # --- FIX 1: Force "Restricted" to show as "Member" ---
         if status == "Restricted":
@@ -746,6 +1267,7 @@ async def mcount_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 3. UPDATE DATABASE
     # Note: Ensure set_message_count exists in your database.py
     await db.set_message_count(target_chat_id, target_user_id, new_count)
+    activity_board.invalidate(target_chat_id)
     
     await msg.reply_text(
         f"✅ **Rank Updated**\n"
@@ -819,6 +1341,100 @@ async def rscore_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"⭐ New Score: {new_score}",
         parse_mode=ParseMode.HTML
     )
+
+# ================= Activity Leaderboard =================
+
+class ActivityLeaderboard:
+    """
+    Per-chat top-K by message count. Seeded from the DB on first use, then
+    kept current from increment_total_messages results, so /top never
+    sorts the table. Counts only grow, so a user can only enter the top-K
+    by beating its lowest entry; manual /mcount edits invalidate the chat.
+    """
+    def __init__(self, k: int):
+        self.k = k
+        self._boards: dict[int, dict[int, int]] = {} # chat_id -> {user_id: total_messages}
+        self._names: dict[int, dict[int, str]] = {}  # chat_id -> {user_id: first_name} for board members
+        self._generations: dict[int, int] = {}       # chat_id -> bumped by invalidate(), checked by _seed()
+        self._seeding = SingleFlight()
+
+    async def top(self, chat_id: int) -> list[tuple[int, int]]:
+        board = self._boards.get(chat_id)
+        if board is None:
+            board = await self._seeding.do(chat_id, lambda: self._seed(chat_id))
+        return sorted(board.items(), key=lambda kv: kv[1], reverse=True)
+
+    async def _seed(self, chat_id: int) -> dict[int, int]:
+        generation = self._generations.get(chat_id, 0)
+        rows = await db.get_top_activity(chat_id, self.k)
+        board = {row['user_id']: row['total_messages'] for row in rows}
+        if self._generations.get(chat_id, 0) != generation:
+            return board # Invalidated mid-read: answer this caller, but don't cache a snapshot that may be stale
+        self._boards[chat_id] = board
+        self._names.setdefault(chat_id, {})
+        return board
+
+    def observe(self, chat_id: int, user_id: int, count: int, first_name: str):
+        board = self._boards.get(chat_id)
+        if board is None:
+            return # Not seeded yet; the first /top reads the DB
+        names = self._names[chat_id]
+        if user_id not in board and len(board) >= self.k:
+            lowest = min(board, key=board.get)
+            if count <= board[lowest]:
+                return
+            del board[lowest]
+            names.pop(lowest, None)
+        board[user_id] = count
+        names[user_id] = first_name
+
+    def name(self, chat_id: int, user_id: int) -> Optional[str]:
+        return self._names.get(chat_id, {}).get(user_id)
+
+    async def rank_of(self, chat_id: int, user_id: int) -> tuple[Optional[int], int]:
+        """(rank, count): from memory for top-K members, else one indexed count query."""
+        ranked = await self.top(chat_id)
+        for position, (uid, count) in enumerate(ranked, start=1):
+            if uid == user_id:
+                return position, count
+        return await db.get_activity_rank(chat_id, user_id)
+
+    def invalidate(self, chat_id: int):
+        self._generations[chat_id] = self._generations.get(chat_id, 0) + 1
+        self._boards.pop(chat_id, None)
+        self._names.pop(chat_id, None)
+
+activity_board = ActivityLeaderboard(LEADERBOARD_CACHE_SIZE)
+
+async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows the most active members of this group."""
+    chat = update.effective_chat
+    user = update.effective_user
+    ranked = (await activity_board.top(chat.id))[:10]
+
+    if not ranked:
+        await update.effective_message.reply_text("📉 No activity data yet.")
+        return
+
+    text = "📊 <b>Most Active Members</b>\n━━━━━━━━━━━━━━━━━━\n"
+    icons = {1: "🥇", 2: "🥈", 3: "🥉"}
+    for index, (user_id, count) in enumerate(ranked, start=1):
+        name = activity_board.name(chat.id, user_id)
+        if name is None:
+            try:
+                member = await tg_lookup.get_chat_member(context.bot, chat.id, user_id)
+                name = member.user.first_name
+            except TelegramError:
+                name = "Unknown"
+        user_display = f"<a href='tg://user?id={user_id}'>{html.escape(name)}</a>" if index <= 5 else html.escape(name)
+        text += f"{icons.get(index, '▫️')} <b>No. {index} ({get_rank_string(count)})</b> {user_display} — <code>{count} msgs</code>\n"
+
+    rank, count = await activity_board.rank_of(chat.id, user.id)
+    if rank:
+        text += f"\n<i>Your position: No. {rank} with {count} messages.</i>"
+
+    await update.effective_message.reply_text(text, parse_mode=ParseMode.HTML)
+
 async def toprep_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 1. Get Top 10 Users by Reputation
     rows = await db.get_top_reputation(10)
@@ -840,7 +1456,7 @@ async def toprep_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Get Name
         try:
-            member = await context.bot.get_chat_member(chat.id, user_id)
+            member = await tg_lookup.get_chat_member(context.bot, chat.id, user_id)
             name = html.escape(member.user.first_name)
         except Exception:
             name = "Unknown"
@@ -874,9 +1490,29 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     users = await db.get_all_bot_users()
     await update.message.reply_text(f"🚀 Sending to {len(users)} users...")
     for u in users:
-        try: await context.bot.send_message(u['user_id'], " ".join(context.args))
+        try: await context.bot.send_message(u['user_id'], " ".join(context.args), rate_limit_args=PRIORITY_BULK)
         except: pass
 
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows runtime metrics (System Admins only)."""
+    if update.effective_user.id not in SYSTEM_BOT_IDS: return
+    lines = ["📈 <b>Runtime Stats</b>", "", "<b>Webhook Ingest</b>"]
+    lines.append(f"Received: {ingest_stats['received']} | Pre-filtered: {ingest_stats['prefiltered']}")
+    lines += ingest_queue.stats_lines()
+    lines += update_dedup.stats_lines()
+    lines += ["", "<b>Update Processing</b>"] + update_processor.stats_lines()
+    lines += ["", "<b>Telegram Lookups</b>"] + tg_lookup.stats_lines()
+    lines += ["", "<b>Outbound API</b>"] + rate_limiter.stats_lines()
+    lines += ["", "<b>Spam Deletes</b>"] + delete_batcher.stats_lines()
+    lines += notice_aggregator.stats_lines()
+    lines += verdict_cache.stats_lines()
+    lines += media_flood.stats_lines()
+    lines += ["", "<b>Join Raids</b>"] + join_guard.stats_lines()
+    lines.append(f"Blocklist: {len(blocklist.users)} users, {len(blocklist.chats)} chats opted in, {blocklist.hits} hits")
+    lines.append(f"Author index: {author_index.hits} hits, {author_index.misses} misses, {len(author_index)} unflushed")
+    lines += ["", "<b>Database</b>"] + db.pool_stats_lines()
+    await update.effective_message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
 async def add_feed_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args: return
     await db.add_rss_feed(context.args[0], update.effective_chat.id)
@@ -892,15 +1528,18 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "🤖 **Bot Commands & Features**\n\n"
         "**User Commands:**\n"
         "• `/start`: Initiate the file download process (in private chat).\n"
-        "• `/help`: Show this help message.\n\n"
+        "• `/help`: Show this help message.\n"
+        "• `/top`: Most active members of this group.\n\n"
         "**Admin Commands (Group Only):**\n"
         "• `/warn [reason]`: Warn a user.\n"
         "• `/mute [user]`: Mute a user for 24 hours.\n"
         "• `/unmute [user]`: Unmute a user.\n"
         "• `/ban [user]`: Permanently ban a user.\n"
         "• `/unban [user]`: Unban a user.\n"
+        "• `/purge [N|user]`: Delete the last N messages, or a user's recent messages.\n"
         "• `/set_strict_mode [on/off]`: Toggle strict mode for new users.\n"
         "• `/set_ml_check [on/off]`: Toggle ML spam detection.\n"
+        "• `/set_blocklist [on/off]`: Use the shared spammer blocklist.\n"
         "• `/check_permissions`: Check bot's admin rights in this chat.\n"
     )
     await update.effective_message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
@@ -930,6 +1569,7 @@ async def mute_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard = [[InlineKeyboardButton("✅ Unmute", callback_data=f"unmute:{update.effective_chat.id}:{target_id}")]]
         await update.effective_message.reply_text(caption, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
         logger.info(f"Admin {update.effective_user.id} muted user {target_id}")
+        context.application.create_task(after_sanction(context.bot, update.effective_chat.id, target_id))
     except TelegramError as e:
         await update.effective_message.reply_text(f"Failed to mute user: {e}")
 
@@ -978,6 +1618,7 @@ async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard = [[InlineKeyboardButton("↩️ Unban", callback_data=f"unban:{update.effective_chat.id}:{target_id}")]]
         await update.effective_message.reply_text(caption, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
         logger.info(f"Admin {update.effective_user.id} banned user {target_id}.")
+        context.application.create_task(after_sanction(context.bot, update.effective_chat.id, target_id, "banned by admin"))
     except TelegramError as e:
         await update.effective_message.reply_text(f"Failed to ban user: {e}")
 
@@ -1003,6 +1644,43 @@ async def unban_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.info(f"Admin {update.effective_user.id} unbanned user {target_id}.")
     except TelegramError as e:
         await update.effective_message.reply_text(f"Failed to unban user: {e}")
+        return
+    await blocklist.remove(target_id, update.effective_chat.id) # An admin reversed the ban: not a confirmed spammer here
+
+async def purge_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/purge N deletes the last N messages; /purge <user> deletes that user's recent messages."""
+    if not update.effective_chat: return
+    if not await is_admin(update, context): return
+    chat_id = update.effective_chat.id
+    msg = update.effective_message
+
+    count = int(context.args[0]) if context.args and context.args[0].isdigit() else None
+    if count is not None and count > PURGE_MAX_COUNT:
+        # Large numbers are user ids only if they resolve to someone in this chat
+        try:
+            await tg_lookup.get_chat_member(context.bot, chat_id, count)
+        except TelegramError:
+            await msg.reply_text(f"⚠️ /purge can delete at most {PURGE_MAX_COUNT} messages at once.")
+            return
+        count = None
+    if count is not None:
+        ids = recent_message_ids(chat_id, limit=count)
+        label = f"last {count} message(s)"
+    else:
+        target = await get_target_user_id(update, context)
+        if not target: return
+        target_id, target_display = target
+        ids = recent_message_ids(chat_id, user_id=target_id)
+        label = f"recent messages from {target_display}"
+
+    ids = [i for i in ids if i != msg.message_id] + [msg.message_id]
+    deleted = await purge_messages(context.bot, chat_id, ids)
+    # Count excludes the /purge command itself
+    await context.bot.send_message(
+        chat_id, f"🧹 Purged {max(deleted - 1, 0)} of the {label}.", parse_mode=ParseMode.HTML,
+        rate_limit_args=PRIORITY_MODERATION
+    )
+    logger.info(f"Admin {update.effective_user.id} purged {deleted} message(s) in {chat_id}.")
 
 async def warn_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
@@ -1036,33 +1714,34 @@ async def warn_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # The DB needs a number, but the link might give a string.
         if isinstance(target_chat_id, str):
             try:
-                chat_obj = await context.bot.get_chat(target_chat_id)
+                chat_obj = await tg_lookup.get_chat(context.bot, target_chat_id)
                 target_chat_id = chat_obj.id
             except Exception as e:
                 await update.message.reply_text(f"❌ Could not find chat ID for {target_chat_id}: {e}")
                 return
         # -----------------------------------------------------------
 
-        # --- A. Fetch User ID (Forward Trick) ---
-        target_user = None
-        try:
-            dummy_msg = await context.bot.forward_message(
-                chat_id=update.effective_chat.id, 
-                from_chat_id=target_chat_id, 
-                message_id=target_msg_id
-            )
+        # --- A. Fetch User ID (author index first, forward trick as fallback) ---
+        target_user = await author_index.lookup(target_chat_id, target_msg_id)
+        if not target_user:
+            try:
+                dummy_msg = await context.bot.forward_message(
+                    chat_id=update.effective_chat.id, 
+                    from_chat_id=target_chat_id, 
+                    message_id=target_msg_id
+                )
             
-            if hasattr(dummy_msg, 'forward_origin') and dummy_msg.forward_origin:
-                 if dummy_msg.forward_origin.type == 'user':
-                     target_user = dummy_msg.forward_origin.sender_user
-            elif dummy_msg.forward_from:
-                 target_user = dummy_msg.forward_from
+                if hasattr(dummy_msg, 'forward_origin') and dummy_msg.forward_origin:
+                     if dummy_msg.forward_origin.type == 'user':
+                         target_user = dummy_msg.forward_origin.sender_user
+                elif dummy_msg.forward_from:
+                     target_user = dummy_msg.forward_from
 
-            await dummy_msg.delete()
+                await dummy_msg.delete()
             
-        except Exception as e:
-            await update.message.reply_text(f"❌ Error fetching message details: {e}")
-            return
+            except Exception as e:
+                await update.message.reply_text(f"❌ Error fetching message details: {e}")
+                return
 
         if not target_user:
             await update.message.reply_text("❌ Could not determine the user (Forward Privacy might be enabled).")
@@ -1073,7 +1752,7 @@ async def warn_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # --- B. Admin Protection Check ---
         try:
-            target_member = await context.bot.get_chat_member(target_chat_id, target_user_id)
+            target_member = await tg_lookup.get_chat_member(context.bot, target_chat_id, target_user_id)
             if target_member.status in ['administrator', 'creator']:
                 await update.message.reply_text("⛔ **Error:** I cannot warn or mute other Admins.", parse_mode=ParseMode.MARKDOWN)
                 return
@@ -1100,6 +1779,7 @@ async def warn_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     permissions=ChatPermissions(can_send_messages=False),
                     until_date=until_date
                 )
+                context.application.create_task(after_sanction(context.bot, target_chat_id, target_user_id, "3/3 warnings"))
                 caption = (
                     f"🔇 **User Muted**\n"
                     f"• User: {target_display}\n"
@@ -1163,6 +1843,7 @@ async def warn_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 permissions=ChatPermissions(can_send_messages=False),
                 until_date=until_date
             )
+            context.application.create_task(after_sanction(context.bot, chat.id, target_id, "3/3 warnings"))
             caption = (
                 f"🔇 **User Muted**\n"
                 f"• User: {target_display}\n"
@@ -1226,6 +1907,46 @@ async def set_ml_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
         message = "Invalid argument. Use `on` or `off`."
     await update.effective_message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
 
+async def set_blocklist(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Opts this chat in/out of the shared spammer blocklist."""
+    if not update.effective_chat: return
+    chat_id = update.effective_chat.id
+    if not await is_admin(update, context): return
+    settings = await db.get_chat_settings(chat_id)
+    if not context.args:
+        current_state = "ON" if settings.get("use_blocklist", False) else "OFF"
+        await update.effective_message.reply_text(
+            f"Shared Spammer Blocklist is **{current_state}**.\n"
+            f"Usage: `/set_blocklist on` or `off`\n\n"
+            f"*(Mutes users banned or muted 3/3 in our other groups as soon as they post or join.)*",
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return
+    arg = context.args[0].lower()
+    if arg in ["on", "true", "enable", "1"]:
+        await db.set_chat_setting(chat_id, 'use_blocklist', True)
+        blocklist.set_chat(chat_id, True)
+        message = "✅ Shared Spammer Blocklist **Enabled**."
+    elif arg in ["off", "false", "disable", "0"]:
+        await db.set_chat_setting(chat_id, 'use_blocklist', False)
+        blocklist.set_chat(chat_id, False)
+        message = "❌ Shared Spammer Blocklist **Disabled**."
+    else:
+        message = "Invalid argument. Use `on` or `off`."
+    await update.effective_message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
+
+async def unblock_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Removes a user from the shared blocklist (System Admins only)."""
+    if update.effective_user.id not in SYSTEM_BOT_IDS: return
+    if not context.args or not context.args[0].isdigit():
+        await update.effective_message.reply_text("Usage: `/unblock <user_id>`", parse_mode=ParseMode.MARKDOWN)
+        return
+    user_id = int(context.args[0])
+    if await blocklist.remove(user_id):
+        await update.effective_message.reply_text(f"✅ <code>{user_id}</code> removed from the blocklist.", parse_mode=ParseMode.HTML)
+    else:
+        await update.effective_message.reply_text(f"ℹ️ <code>{user_id}</code> is not on the blocklist.", parse_mode=ParseMode.HTML)
+
 async def set_reaction_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Toggles the auto-reaction feature for admins and channels."""
     if not update.effective_chat: return
@@ -1287,24 +2008,1178 @@ async def check_permissions(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error checking permissions in {chat.id}: {e}")
         await update.effective_message.reply_text(f"Failed to check permissions: {e}")
 
+# ================= Ingest Queue =================
+
+class IngestQueue(asyncio.Queue):
+    """
+    Update queue that tracks the backlog: updates accepted by the webhook
+    and not yet marked done by PTB (task_done runs after processing, not
+    after dequeue, so this includes updates waiting on a handler slot).
+    """
+    def __init__(self, max_backlog: int):
+        super().__init__()
+        self.max_backlog = max_backlog
+        self.backlog = 0
+        self.peak = 0
+        self.accepted = 0
+        self.shed = 0
+        self.degraded = False
+
+    def saturated(self) -> bool:
+        return bool(self.max_backlog) and self.backlog >= self.max_backlog
+
+    def offer(self, update: Update) -> bool:
+        """Enqueues the update unless saturated. Returns False if it was shed."""
+        if self.saturated():
+            self.shed += 1
+            return False
+        self.put_nowait(update)
+        self.accepted += 1
+        self.backlog += 1
+        self.peak = max(self.peak, self.backlog)
+        self._update_mode()
+        return True
+
+    def task_done(self):
+        super().task_done()
+        if self.backlog > 0:
+            self.backlog -= 1
+            self._update_mode()
+
+    def _update_mode(self):
+        if not self.max_backlog:
+            return
+        if not self.degraded and self.backlog >= self.max_backlog * DEGRADED_ENTER_RATIO:
+            self.degraded = True
+            logger.warning(f"Update backlog at {self.backlog}: entering degraded mode (moderation only).")
+        elif self.degraded and self.backlog <= self.max_backlog * DEGRADED_EXIT_RATIO:
+            self.degraded = False
+            logger.info(f"Update backlog drained to {self.backlog}: leaving degraded mode.")
+
+    def stats_lines(self) -> list[str]:
+        limit = self.max_backlog or "∞"
+        return [
+            f"Backlog: {self.backlog}/{limit} (peak {self.peak})",
+            f"Accepted: {self.accepted} | Shed: {self.shed}",
+            f"Degraded: {'YES' if self.degraded else 'no'}",
+        ]
+
+# ================= Outbound Rate Limiter =================
+
+class PriorityGate:
+    """Token bucket whose waiters are served in priority order (FIFO within a class)."""
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters = [deque() for _ in PRIORITY_NAMES]
+        self._pump: Optional[asyncio.Task] = None
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds: float):
+        """Stops handing out tokens for `seconds` (after a RetryAfter)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def waiting(self, priority: int) -> int:
+        return len(self._waiters[priority])
+
+    def idle(self) -> bool:
+        self._refill(time.monotonic())
+        return self._pump is None and self._tokens >= self.burst
+
+    async def acquire(self, priority: int):
+        now = time.monotonic()
+        self._refill(now)
+        # Fast path only when nobody is queued, so waiters are never overtaken
+        if self._pump is None and now >= self._paused_until and self._tokens >= 1:
+            self._tokens -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[priority].append(waiter)
+        if self._pump is None:
+            self._pump = asyncio.create_task(self._serve())
+        await waiter
+
+    def _head(self) -> Optional[deque]:
+        for queue in self._waiters:
+            while queue and queue[0].cancelled():
+                queue.popleft()
+            if queue:
+                return queue
+        return None
+
+    async def _serve(self):
+        try:
+            while (queue := self._head()) is not None:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens < 1:
+                    await asyncio.sleep((1 - self._tokens) / self.rate)
+                    continue # Re-check: a higher priority waiter may have arrived
+                self._tokens -= 1
+                queue.popleft().set_result(None)
+        finally:
+            self._pump = None
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """
+    Central outbound scheduler for the Bot API: a global limit on all calls,
+    per-chat limits on sends, RetryAfter honoured by pausing the affected
+    gate, and waiting calls served moderation > interactive > bulk.
+    """
+    def __init__(self):
+        self._global = PriorityGate(RATE_GLOBAL_PER_SEC, RATE_GLOBAL_PER_SEC)
+        self._chats: dict[Any, PriorityGate] = {}
+        self.wait_times = [LatencyHistogram() for _ in PRIORITY_NAMES]
+        self.retry_afters = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_gate(self, chat_id) -> PriorityGate:
+        gate = self._chats.get(chat_id)
+        if gate is None:
+            if len(self._chats) > 1000:
+                for key in [k for k, g in self._chats.items() if g.idle()]:
+                    del self._chats[key]
+            is_private = isinstance(chat_id, int) and chat_id > 0
+            gate = PriorityGate(RATE_PRIVATE_PER_SEC, 1) if is_private else PriorityGate(RATE_GROUP_PER_MIN / 60, 3)
+            self._chats[chat_id] = gate
+        return gate
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args if rate_limit_args in (PRIORITY_MODERATION, PRIORITY_INTERACTIVE, PRIORITY_BULK) else PRIORITY_INTERACTIVE
+        chat_id = data.get("chat_id")
+        is_send = endpoint.startswith(("send", "copy", "forward"))
+        chat_gate = self._chat_gate(chat_id) if is_send and chat_id is not None else None
+
+        queued_at = time.monotonic()
+        for attempt in range(RATE_MAX_RETRIES + 1):
+            if chat_gate:
+                await chat_gate.acquire(priority)
+            await self._global.acquire(priority)
+            if attempt == 0:
+                self.wait_times[priority].observe(time.monotonic() - queued_at)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                self.retry_afters += 1
+                (chat_gate or self._global).pause(delay)
+                logger.warning(f"RetryAfter {delay:.0f}s on {endpoint} (chat {chat_id}, {PRIORITY_NAMES[priority]}).")
+                if attempt == RATE_MAX_RETRIES:
+                    raise
+
+    def stats_lines(self) -> list[str]:
+        lines = [f"Chat gates: {len(self._chats)} | RetryAfter: {self.retry_afters}"]
+        for priority, name in enumerate(PRIORITY_NAMES):
+            depth = self._global.waiting(priority) + sum(g.waiting(priority) for g in self._chats.values())
+            lines.append(f"• {name}: queued {depth} | wait {self.wait_times[priority].summary()}")
+        return lines
+
+# ================= Delete Batching =================
+
+class DeleteBatcher:
+    """
+    Merges spam deletions in the same chat into deleteMessages calls.
+    The first delete goes out immediately; ids arriving while a call is in
+    flight are queued and sent together as the next batch (Nagle-style).
+    """
+    def __init__(self):
+        self._pending: dict[int, list[tuple[int, asyncio.Future]]] = {}
+        self._flushers: dict[int, asyncio.Task] = {}
+        self.calls = 0
+        self.deleted = 0
+        self.failed = 0
+        self.time_to_delete = LatencyHistogram()
+
+    def _enqueue(self, bot_, chat_id: int, message_id: int) -> asyncio.Future:
+        waiter = asyncio.get_running_loop().create_future()
+        queue = self._pending.get(chat_id)
+        if queue is None:
+            self._pending[chat_id] = [(message_id, waiter)]
+            self._flushers[chat_id] = asyncio.create_task(self._flush(bot_, chat_id))
+        else:
+            queue.append((message_id, waiter))
+        return waiter
+
+    async def delete(self, bot_, chat_id: int, message_id: int) -> bool:
+        return await self._enqueue(bot_, chat_id, message_id)
+
+    def delete_detached(self, bot_, chat_id: int, message_id: int, verdict_at: float):
+        """Fire-and-forget delete so the handler (and the next update in this chat) doesn't wait on it."""
+        def observed(waiter: asyncio.Future):
+            if not waiter.cancelled() and waiter.result():
+                self.time_to_delete.observe(time.monotonic() - verdict_at)
+        self._enqueue(bot_, chat_id, message_id).add_done_callback(observed)
+
+    async def delete_many(self, bot_, chat_id: int, message_ids: list[int]) -> int:
+        """Queues all ids at once so they leave in full batches. Returns how many were deleted."""
+        waiters = [self._enqueue(bot_, chat_id, message_id) for message_id in message_ids]
+        return sum(await asyncio.gather(*waiters))
+
+    async def _flush(self, bot_, chat_id: int):
+        queue = self._pending[chat_id]
+        try:
+            while queue:
+                batch = queue[:DELETE_BATCH_MAX]
+                del queue[:DELETE_BATCH_MAX]
+                ids = [message_id for message_id, _ in batch]
+                self.calls += 1
+                try:
+                    if len(ids) == 1:
+                        ok = await bot_.delete_message(chat_id, ids[0], rate_limit_args=PRIORITY_MODERATION)
+                    else:
+                        ok = await bot_.delete_messages(chat_id, ids, rate_limit_args=PRIORITY_MODERATION)
+                except TelegramError as e:
+                    logger.error(f"Failed to delete {len(ids)} message(s) in {chat_id}: {e}")
+                    ok = False
+                if ok: self.deleted += len(ids)
+                else: self.failed += len(ids)
+                for _, waiter in batch:
+                    if not waiter.done():
+                        waiter.set_result(bool(ok))
+        finally:
+            del self._pending[chat_id]
+            self._flushers.pop(chat_id, None)
+            for _, waiter in queue: # Only non-empty if we were cancelled
+                if not waiter.done():
+                    waiter.set_result(False)
+
+    def stats_lines(self) -> list[str]:
+        per_call = self.deleted / self.calls if self.calls else 0
+        return [
+            f"Ids per deleteMessages call: {per_call:.1f}",
+            f"Deleted: {self.deleted} in {self.calls} calls | Failed: {self.failed}",
+            f"Time to delete: {self.time_to_delete.summary()}",
+        ]
+
+delete_batcher = DeleteBatcher()
+
+# ================= Raid Notice Coalescing =================
+
+class RaidSummary:
+    __slots__ = ("message_id", "entries", "notes", "notes_dropped", "started", "updated")
+
+    def __init__(self, now: float):
+        self.message_id: Optional[int] = None
+        self.entries: list[list] = [] # [line, button or None once resolved]
+        self.notes: list[str] = []
+        self.notes_dropped = 0
+        self.started = now
+        self.updated = now
+
+class NoticeAggregator:
+    """
+    Per-chat moderation notices. Below NOTICE_RAID_THRESHOLD events per
+    NOTICE_RATE_WINDOW each notice goes out on its own as before; above it,
+    notices are buffered briefly and folded into one summary message with
+    the combined buttons, edited in place while it is recent and has room.
+    notify() never waits on the chat's send rate limit: sends run as tasks,
+    so a throttled notice can't hold up the chat's serialized updates.
+    """
+    def __init__(self):
+        self._events: dict[int, deque] = {}
+        self._pending: dict[int, list[list]] = {}
+        self._summaries: dict[int, RaidSummary] = {}
+        self._flushers: dict[int, asyncio.Task] = {}
+        self._sends: set[asyncio.Task] = set()
+        self.sent_individual = 0
+        self.coalesced = 0
+        self.summary_messages = 0
+
+    def _raiding(self, chat_id: int, now: float) -> bool:
+        events = self._events.setdefault(chat_id, deque())
+        events.append(now)
+        while events and now - events[0] > NOTICE_RATE_WINDOW:
+            events.popleft()
+        summary = self._summaries.get(chat_id)
+        # Stay in summary mode briefly after the burst so the tail doesn't trickle out one by one
+        recent_summary = summary is not None and now - summary.updated < NOTICE_RATE_WINDOW
+        return chat_id in self._pending or recent_summary or len(events) > NOTICE_RAID_THRESHOLD
+
+    async def notify(self, bot_, chat_id: int, caption: str, reply_markup, line: str, button: InlineKeyboardButton):
+        now = time.monotonic()
+        if not self._raiding(chat_id, now):
+            self.sent_individual += 1
+            task = asyncio.create_task(self._send(bot_, chat_id, caption, reply_markup))
+            self._sends.add(task)
+            task.add_done_callback(self._sends.discard)
+            return
+        self.coalesced += 1
+        pending = self._pending.get(chat_id)
+        if pending is None:
+            pending = self._pending[chat_id] = []
+            self._flushers[chat_id] = asyncio.create_task(self._flush_later(bot_, chat_id))
+        pending.append([line, button])
+
+    @staticmethod
+    async def _send(bot_, chat_id: int, caption: str, reply_markup):
+        try:
+            await bot_.send_message(
+                chat_id=chat_id, text=caption, reply_markup=reply_markup,
+                parse_mode=ParseMode.HTML, rate_limit_args=PRIORITY_MODERATION
+            )
+        except TelegramError as e:
+            logger.error(f"Failed to send moderation notice in {chat_id}: {e}")
+
+    async def _flush_later(self, bot_, chat_id: int):
+        try:
+            await asyncio.sleep(NOTICE_FLUSH_DELAY)
+            entries = self._pending.pop(chat_id, [])
+            now = time.monotonic()
+            summary = self._summaries.get(chat_id)
+            while entries:
+                fresh = summary is not None and now - summary.started < NOTICE_SUMMARY_EDIT_WINDOW
+                if not fresh or not self._fits(summary, entries[0]):
+                    summary = self._summaries[chat_id] = RaidSummary(now)
+                summary.entries.append(entries.pop(0))
+                while entries and self._fits(summary, entries[0]):
+                    summary.entries.append(entries.pop(0))
+                summary.updated = now
+                await self._render(bot_, chat_id, summary)
+        finally:
+            # A newer burst may already have its own flusher registered
+            if self._flushers.get(chat_id) is asyncio.current_task():
+                del self._flushers[chat_id]
+
+    @staticmethod
+    def _fits(summary: RaidSummary, entry: list) -> bool:
+        """Whether one more entry stays within NOTICE_SUMMARY_MAX and 3/4 of the text limit;
+        the rest is left for the header and notes (notes are shed first if space runs out)."""
+        if len(summary.entries) >= NOTICE_SUMMARY_MAX:
+            return False
+        used = sum(len(line) + 6 for line, _ in summary.entries) + len(entry[0]) + 6
+        return used <= NOTICE_TEXT_MAX * 3 // 4
+
+    @staticmethod
+    def _text(summary: RaidSummary) -> str:
+        text = f"🛡️ <b>Raid protection</b>: {len(summary.entries)} moderation action(s)\n\n"
+        text += "\n".join(f"{i}. {line}" for i, (line, _) in enumerate(summary.entries, 1))
+        notes, dropped = list(summary.notes), summary.notes_dropped
+        while True:
+            tail = ""
+            if dropped:
+                tail += f"\n\n…and {dropped} earlier update(s)"
+            if notes:
+                tail += ("\n" if dropped else "\n\n") + "\n".join(notes)
+            if len(text) + len(tail) <= NOTICE_TEXT_MAX or not notes:
+                break
+            notes.pop(0)
+            dropped += 1
+        return text + tail
+
+    async def _render(self, bot_, chat_id: int, summary: RaidSummary):
+        text = self._text(summary)
+        buttons = [button for _, button in summary.entries if button]
+        rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+        markup = InlineKeyboardMarkup(rows) if rows else None
+        try:
+            if summary.message_id:
+                await bot_.edit_message_text(
+                    chat_id=chat_id, message_id=summary.message_id, text=text,
+                    reply_markup=markup, parse_mode=ParseMode.HTML, rate_limit_args=PRIORITY_MODERATION
+                )
+                return
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return
+            logger.warning(f"Raid summary edit failed in {chat_id}, posting a new one: {e}")
+        except TelegramError as e:
+            logger.warning(f"Raid summary edit failed in {chat_id}: {e}")
+            return
+        try:
+            sent = await bot_.send_message(
+                chat_id=chat_id, text=text, reply_markup=markup,
+                parse_mode=ParseMode.HTML, rate_limit_args=PRIORITY_MODERATION
+            )
+            summary.message_id = sent.message_id
+            self.summary_messages += 1
+        except TelegramError as e:
+            logger.error(f"Failed to send raid summary in {chat_id}: {e}")
+
+    async def resolve(self, bot_, message: Message, callback_data: str, status: str) -> bool:
+        """Handles a button pressed on a tracked summary: drops that button and notes the outcome."""
+        summary = self._summaries.get(message.chat_id)
+        if summary is None or summary.message_id != message.message_id:
+            return False
+        for entry in summary.entries:
+            if entry[1] is not None and entry[1].callback_data == callback_data:
+                entry[1] = None
+        summary.notes.append(status)
+        if len(summary.notes) > NOTICE_SUMMARY_NOTES:
+            summary.notes_dropped += len(summary.notes) - NOTICE_SUMMARY_NOTES
+            del summary.notes[:-NOTICE_SUMMARY_NOTES]
+        await self._render(bot_, message.chat_id, summary)
+        return True
+
+    def prune(self):
+        now = time.monotonic()
+        for chat_id in [c for c, s in self._summaries.items() if now - s.updated > NOTICE_SUMMARY_EDIT_WINDOW]:
+            del self._summaries[chat_id]
+        for chat_id in [c for c, e in self._events.items() if not e or now - e[-1] > NOTICE_RATE_WINDOW]:
+            del self._events[chat_id]
+
+    def stats_lines(self) -> list[str]:
+        return [f"Notices: {self.sent_individual} individual, {self.coalesced} coalesced into {self.summary_messages} summaries"]
+
+notice_aggregator = NoticeAggregator()
+
+# ================= Join Raid Lockdown =================
+
+class JoinWindow:
+    """Join count over the last JOIN_RAID_WINDOW seconds, as a ring of per-bucket counters."""
+    __slots__ = ("last_bucket", "counts")
+
+    def __init__(self):
+        self.last_bucket = 0
+        self.counts = array("I", [0] * (JOIN_RAID_WINDOW // JOIN_RAID_BUCKET))
+
+    def add(self, now: float, joins: int) -> int:
+        bucket = int(now // JOIN_RAID_BUCKET)
+        size = len(self.counts)
+        # Zero the buckets we skipped over (at most the whole ring)
+        for b in range(max(self.last_bucket + 1, bucket - size + 1), bucket + 1):
+            self.counts[b % size] = 0
+        self.last_bucket = max(self.last_bucket, bucket)
+        self.counts[bucket % size] += joins
+        return sum(self.counts)
+
+class Lockdown:
+    __slots__ = ("until", "restricted", "forgotten", "untracked", "queue", "overflow", "announce", "worker")
+
+    def __init__(self, until: float, announce: str):
+        self.until = until
+        self.restricted = array("q") # Muted by us; released gradually afterwards
+        self.forgotten: set[int] = set() # Sanctioned meanwhile; skipped when their turn to be released comes
+        self.untracked = 0           # Muted past JOIN_LOCKDOWN_MAX_TRACKED; left to their until_date
+        self.queue: list[int] = []   # Joiners waiting to be muted (at most JOIN_QUEUE_MAX)
+        self.overflow = 0            # Joiners that didn't fit in the queue
+        self.announce = announce     # Posted by the worker, off the join handler's path
+        self.worker: Optional[asyncio.Task] = None
+
+class JoinRaidGuard:
+    def __init__(self):
+        self._windows: dict[int, JoinWindow] = {}
+        self._lockdowns: dict[int, Lockdown] = {}
+        self.raids = 0
+        self.restricted_total = 0
+        self.lifted_total = 0
+        self.overflow_total = 0
+
+    def in_lockdown(self, chat_id: int) -> bool:
+        return chat_id in self._lockdowns
+
+    async def observe(self, bot_, chat_id: int, user_ids: list[int]):
+        """Called for every batch of human joiners. Never blocks on the restrictions."""
+        now = time.time()
+        window = self._windows.get(chat_id)
+        if window is None:
+            window = self._windows[chat_id] = JoinWindow()
+        rate = window.add(now, len(user_ids))
+
+        lockdown = self._lockdowns.get(chat_id)
+        if lockdown is None:
+            if rate < JOIN_RAID_THRESHOLD:
+                return
+            lockdown = self._lockdowns[chat_id] = Lockdown(
+                now + JOIN_LOCKDOWN_SECONDS,
+                f"🚨 <b>Join raid detected</b> ({rate} joins in {JOIN_RAID_WINDOW}s).\n"
+                f"New members are muted for now and will be released gradually once it stops."
+            )
+            self.raids += 1
+            logger.warning(f"Join raid in {chat_id}: {rate} joins in {JOIN_RAID_WINDOW}s, locking down.")
+        elif rate >= JOIN_RAID_THRESHOLD:
+            lockdown.until = max(lockdown.until, now + JOIN_LOCKDOWN_SECONDS)
+        elif now >= lockdown.until:
+            return # Releasing after the raid; ordinary joins are left alone
+
+        room = JOIN_QUEUE_MAX - len(lockdown.queue)
+        lockdown.queue.extend(user_ids[:max(room, 0)])
+        overflow = max(len(user_ids) - max(room, 0), 0)
+        lockdown.overflow += overflow
+        self.overflow_total += overflow
+        if lockdown.worker is None:
+            lockdown.worker = asyncio.create_task(self._run(bot_, chat_id, lockdown))
+
+    def forget(self, chat_id: int, user_id: int):
+        """Drops a user from the release list (they were banned/muted for cause meanwhile)."""
+        lockdown = self._lockdowns.get(chat_id)
+        if lockdown:
+            lockdown.forgotten.add(user_id)
+
+    async def _apply(self, bot_, chat_id: int, user_ids: list[int], permissions: ChatPermissions, until_date=None) -> int:
+        gate = asyncio.Semaphore(JOIN_RESTRICT_CONCURRENCY)
+        async def one(user_id) -> bool:
+            async with gate:
+                try:
+                    await bot_.restrict_chat_member(
+                        chat_id, user_id, permissions, until_date=until_date,
+                        rate_limit_args=PRIORITY_MODERATION
+                    )
+                    return True
+                except TelegramError as e:
+                    logger.warning(f"Lockdown restriction change failed for {user_id} in {chat_id}: {e}")
+                    return False
+        return sum(await asyncio.gather(*(one(u) for u in user_ids)))
+
+    @staticmethod
+    async def _announce(bot_, chat_id: int, text: str):
+        try:
+            await bot_.send_message(chat_id, text, parse_mode=ParseMode.HTML, rate_limit_args=PRIORITY_MODERATION)
+        except TelegramError as e:
+            logger.error(f"Failed to post lockdown notice in {chat_id}: {e}")
+
+    async def _run(self, bot_, chat_id: int, lockdown: Lockdown):
+        """Mutes queued joiners while locked down, then releases them in small batches."""
+        released = 0
+        overflow_warned = False
+        try:
+            await self._announce(bot_, chat_id, lockdown.announce)
+            while True:
+                if lockdown.overflow and not overflow_warned:
+                    overflow_warned = True
+                    logger.warning(f"Join queue full in {chat_id}, {lockdown.overflow} joiners not held.")
+                    await self._announce(
+                        bot_, chat_id, "⚠️ Joins are arriving faster than they can be muted; some new members "
+                        "were not held. Admins may want to restrict the group manually."
+                    )
+                if lockdown.queue:
+                    batch, lockdown.queue = lockdown.queue, []
+                    until_date = datetime.fromtimestamp(lockdown.until + JOIN_RESTRICT_GRACE, timezone.utc)
+                    self.restricted_total += await self._apply(bot_, chat_id, batch, ChatPermissions(can_send_messages=False), until_date)
+                    room = max(JOIN_LOCKDOWN_MAX_TRACKED - len(lockdown.restricted), 0)
+                    lockdown.restricted.extend(batch[:room])
+                    lockdown.untracked += len(batch) - len(batch[:room])
+                    continue
+                now = time.time()
+                if now < lockdown.until:
+                    await asyncio.sleep(min(JOIN_LIFT_INTERVAL, lockdown.until - now))
+                    continue
+                if not lockdown.restricted:
+                    break
+                release = [u for u in lockdown.restricted[:JOIN_LIFT_BATCH] if u not in lockdown.forgotten]
+                del lockdown.restricted[:JOIN_LIFT_BATCH]
+                lifted = await self._apply(bot_, chat_id, release, _create_unmute_permissions())
+                self.lifted_total += lifted
+                released += lifted
+                await asyncio.sleep(JOIN_LIFT_INTERVAL)
+        finally:
+            self._lockdowns.pop(chat_id, None)
+        logger.info(f"Join raid lockdown in {chat_id} lifted ({released} released, {lockdown.untracked} untracked, {lockdown.overflow} overflowed).")
+        if lockdown.untracked:
+            text = (f"✅ Raid lockdown lifted. Released {released} held members; "
+                    f"the remaining {lockdown.untracked} restrictions expire automatically.")
+        else:
+            text = f"✅ Raid lockdown lifted. Released {released} held members."
+        try:
+            await bot_.send_message(chat_id, text, rate_limit_args=PRIORITY_INTERACTIVE)
+        except TelegramError:
+            pass
+
+    def prune(self):
+        now_bucket = int(time.time() // JOIN_RAID_BUCKET)
+        size = JOIN_RAID_WINDOW // JOIN_RAID_BUCKET
+        for chat_id in [c for c, w in self._windows.items() if now_bucket - w.last_bucket >= size and c not in self._lockdowns]:
+            del self._windows[chat_id]
+
+    def stats_lines(self) -> list[str]:
+        held = sum(len(l.restricted) + len(l.queue) for l in self._lockdowns.values())
+        return [
+            f"Raids: {self.raids} | Active lockdowns: {len(self._lockdowns)} | Held: {held}",
+            f"Muted on join: {self.restricted_total} | Released: {self.lifted_total}",
+            f"Queue overflow: {self.overflow_total} joiners not held",
+        ]
+
+join_guard = JoinRaidGuard()
+
+async def after_sanction(bot_, chat_id: int, user_id: int, blocklist_reason: Optional[str] = None):
+    """
+    Follow-up for bans/mutes: keep them out of lockdown releases, clean up
+    their messages, and (for bans and 3/3 mutes) add them to the shared blocklist.
+    """
+    join_guard.forget(chat_id, user_id)
+    if blocklist_reason:
+        await blocklist.add(user_id, chat_id, blocklist_reason)
+    await purge_user_recent(bot_, chat_id, user_id)
+
+# ================= Shared Spammer Blocklist =================
+
+class SpamBlocklist:
+    """
+    In-memory copy of spam_blocklist plus the opted-in chats and per-chat
+    exemptions, so the check in message_handler is a few set lookups with no
+    DB or ML work.
+    """
+    def __init__(self):
+        self.users: set[int] = set()
+        self.chats: set[int] = set()
+        self.exempt: set[tuple[int, int]] = set() # (chat_id, user_id) cleared by that chat's admins
+        self._synced_at: Optional[datetime] = None
+        self._loaded = False # Until one full load succeeds, every refresh is a full one
+        self.hits = 0
+
+    def blocks(self, chat_id: int, user_id: int) -> bool:
+        return user_id in self.users and chat_id in self.chats and (chat_id, user_id) not in self.exempt
+
+    async def refresh(self, full: bool = False):
+        """Raises DatabaseUnavailable without touching the current sets if anything can't be read."""
+        full = full or not self._loaded
+        since = None if full else self._synced_at
+        user_ids, newest = await db.get_blocklist_since(since)
+        if full:
+            chats = await db.get_blocklist_chats()
+            exempt = await db.get_blocklist_exemptions()
+            self.users, self.chats, self.exempt = set(user_ids), set(chats), set(exempt)
+            self._loaded = True
+        else:
+            self.users.update(user_ids)
+        self._synced_at = newest
+
+    async def add(self, user_id: int, chat_id: int, reason: str):
+        if (chat_id, user_id) in self.exempt: # Sanctioned again where they'd been cleared: enforce there again
+            self.exempt.discard((chat_id, user_id))
+            await noncritical_write(db.remove_blocklist_exemption(chat_id, user_id))
+        if user_id in self.users:
+            return
+        self.users.add(user_id)
+        await noncritical_write(db.add_to_blocklist(user_id, chat_id, reason))
+        logger.info(f"Added {user_id} to the spam blocklist ({reason} in {chat_id}).")
+
+    async def remove(self, user_id: int, chat_id: Optional[int] = None) -> bool:
+        """
+        Global removal when chat_id is None (system admins). A chat's own admins
+        only delete entries their chat created; anything listed elsewhere is
+        just exempted in their chat. The per-chat path never raises on a DB
+        outage: the exemption still applies in memory.
+        """
+        was_listed = user_id in self.users
+        if chat_id is None:
+            self.users.discard(user_id)
+            return await db.remove_from_blocklist(user_id) or was_listed
+        if await noncritical_write(db.remove_from_blocklist(user_id, chat_id)):
+            self.users.discard(user_id)
+            return True
+        if was_listed and (chat_id, user_id) not in self.exempt:
+            self.exempt.add((chat_id, user_id))
+            await noncritical_write(db.add_blocklist_exemption(chat_id, user_id))
+        return was_listed
+
+    def set_chat(self, chat_id: int, enabled: bool):
+        if enabled: self.chats.add(chat_id)
+        else: self.chats.discard(chat_id)
+
+    async def enforce(self, bot_, chat_id: int, user_id: int, message_id: Optional[int] = None):
+        """Deletes the message (if any) and mutes a listed user."""
+        self.hits += 1
+        until_date = datetime.now(timezone.utc) + timedelta(days=BLOCKLIST_MUTE_DAYS)
+        async def mute():
+            try:
+                await bot_.restrict_chat_member(
+                    chat_id, user_id, ChatPermissions(can_send_messages=False),
+                    until_date=until_date, rate_limit_args=PRIORITY_MODERATION
+                )
+            except TelegramError as e:
+                logger.warning(f"Blocklist mute failed for {user_id} in {chat_id}: {e}")
+        tasks = [mute()]
+        if message_id is not None:
+            tasks.append(delete_batcher.delete(bot_, chat_id, message_id))
+        await asyncio.gather(*tasks)
+
+blocklist = SpamBlocklist()
+
+async def refresh_blocklist_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await blocklist.refresh()
+    except db.DatabaseUnavailable as e:
+        logger.warning(f"Blocklist refresh skipped: {e}")
+
+# ================= Edit Verdict Cache =================
+
+def message_fingerprint(text: str, entities) -> bytes:
+    """Hash of everything the spam checks read from a message: text, hidden link targets, formatting count."""
+    digest = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=8)
+    formatting = 0
+    for entity in entities or ():
+        if entity.type == MessageEntityType.TEXT_LINK and entity.url:
+            digest.update(b"\0" + entity.url.encode())
+        elif entity.type in FORMATTING_ENTITY_TYPES:
+            formatting += 1
+    digest.update(b"\0%d" % formatting)
+    return digest.digest()
+
+class VerdictCache:
+    """
+    (chat_id, message_id) -> fingerprint of the last checked version. Edits
+    that don't change the fingerprint skip the rules/ML entirely, and bursts
+    of edits are debounced so only the final version is evaluated.
+    """
+    def __init__(self):
+        self._entries: OrderedDict[tuple[int, int], bytes] = OrderedDict()
+        self._pending: dict[tuple[int, int], asyncio.Task] = {}
+        self._tasks: set[asyncio.Task] = set() # Every deferred check until it finishes, debounced or not
+        self.skipped = 0
+        self.debounced = 0
+
+    def unchanged(self, key: tuple[int, int], fingerprint: bytes) -> bool:
+        if self._entries.get(key) == fingerprint:
+            self._entries.move_to_end(key)
+            self.skipped += 1
+            return True
+        return False
+
+    def store(self, key: tuple[int, int], fingerprint: bytes):
+        self._entries[key] = fingerprint
+        self._entries.move_to_end(key)
+        while len(self._entries) > VERDICT_CACHE_SIZE:
+            self._entries.popitem(last=False)
+
+    def debounce(self, key: tuple[int, int], update: Update, check):
+        """
+        Runs check() after EDIT_DEBOUNCE unless another edit of the same message
+        arrives first. The check goes back through the update processor under
+        this update's key, so it stays ordered with the chat's other updates.
+        """
+        previous = self._pending.get(key)
+        if previous:
+            previous.cancel()
+            self.debounced += 1
+        task = self._pending[key] = asyncio.create_task(self._run_later(key, update, check))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_later(self, key, update: Update, check):
+        await asyncio.sleep(EDIT_DEBOUNCE)
+        if self._pending.get(key) is asyncio.current_task():
+            del self._pending[key] # From here on a newer edit schedules its own check instead of cancelling us
+
+        async def checked():
+            if UPDATE_DEADLINE > 0:
+                db.update_deadline.set(asyncio.get_running_loop().time() + UPDATE_DEADLINE)
+            try:
+                await check()
+            except Exception as e:
+                logger.error(f"Deferred edit check failed for {key}: {e}", exc_info=True)
+        await update_processor.do_process_update(update, checked())
+
+    def stats_lines(self) -> list[str]:
+        return [f"Edit checks: {self.skipped} unchanged skipped, {self.debounced} debounced, {len(self._pending)} pending"]
+
+verdict_cache = VerdictCache()
+
+# ================= Repeated Media Flood =================
+
+def media_unique_id(message: Message) -> Optional[str]:
+    """file_unique_id of the message's media (largest photo size), if any."""
+    if message.photo:
+        return message.photo[-1].file_unique_id
+    media = message.sticker or message.animation or message.video or message.document
+    return media.file_unique_id if media else None
+
+class PosterGeneration:
+    """One open-addressed uint64 table: item key -> first poster (bit 63 set once there are more)."""
+    __slots__ = ("keys", "vals", "multi", "used")
+
+    def __init__(self, size: int):
+        self.keys = array("Q", bytes(8 * size)) # 0 = empty slot
+        self.vals = array("Q", bytes(8 * size))
+        self.multi: dict[int, set[int]] = {}    # Only items with 2+ posters
+        self.used = 0
+
+class PosterTable:
+    """
+    Distinct posters per item over roughly the last MEDIA_FLOOD_WINDOW (between
+    one and two windows). Two generations; an item missing from the current one
+    is carried over from the previous one, and the oldest is dropped wholesale on
+    rotation, so there is no per-entry expiry. Two 8-byte slots per item at <75%
+    load, i.e. about 40 bytes per tracked item, preallocated.
+    """
+    _MULTI = 1 << 63
+
+    def __init__(self, max_entries: int, max_posters: int):
+        self._size = 1 << (max_entries * 4 // 3).bit_length()
+        self._mask = self._size - 1
+        self._limit = max_entries
+        self._max_posters = max_posters
+        self._current = PosterGeneration(self._size)
+        self._previous = PosterGeneration(self._size)
+        self._started = 0
+        self.rotations = 0
+
+    def __len__(self) -> int:
+        return self._current.used + self._previous.used
+
+    def multi_count(self) -> int:
+        return len(self._current.multi) + len(self._previous.multi)
+
+    def rotate(self, now: int):
+        idle = now - self._started >= 2 * MEDIA_FLOOD_WINDOW # Then the current generation is stale too
+        self._previous = PosterGeneration(self._size) if idle else self._current
+        self._current = PosterGeneration(self._size)
+        self._started = now
+        self.rotations += 1
+
+    def expire(self, now: int):
+        if now - self._started >= MEDIA_FLOOD_WINDOW:
+            self.rotate(now)
+
+    def _slot(self, gen: PosterGeneration, key: int) -> int:
+        keys, mask = gen.keys, self._mask
+        i = key & mask
+        while keys[i] != key and keys[i] != 0: # Linear probing; load stays under 75% so this ends
+            i = (i + 1) & mask
+        return i
+
+    def bump(self, key: int, user_id: int, now: int) -> int:
+        """Records user_id as a poster of the item; returns its distinct posters so far."""
+        poster = user_id & (self._MULTI - 1)
+        self.expire(now)
+        gen = self._current
+        i = self._slot(gen, key)
+        if gen.keys[i] == 0:
+            if gen.used >= self._limit:
+                self.rotate(now)
+                gen = self._current
+                i = self._slot(gen, key)
+            gen.keys[i] = key
+            gen.used += 1
+            prev = self._previous
+            j = self._slot(prev, key)
+            if prev.keys[j] != key:
+                gen.vals[i] = poster
+                return 1
+            gen.vals[i] = prev.vals[j]
+            if prev.vals[j] & self._MULTI:
+                gen.multi[key] = prev.multi[key] # Shared with a generation about to be dropped
+        val = gen.vals[i]
+        if val & self._MULTI:
+            posters = gen.multi[key]
+            if len(posters) < self._max_posters:
+                posters.add(poster)
+            return len(posters)
+        if val == poster:
+            return 1
+        gen.vals[i] = val | self._MULTI
+        gen.multi[key] = {val, poster}
+        return 2
+
+class MediaFloodIndex:
+    """
+    Windowed count of distinct posters per file_unique_id, per chat and global,
+    keyed by 64-bit hashes in compact PosterTables.
+    """
+    def __init__(self):
+        self._chat = PosterTable(MEDIA_FLOOD_MAX_ENTRIES, MEDIA_FLOOD_CHAT_THRESHOLD)
+        self._global = PosterTable(MEDIA_FLOOD_MAX_ENTRIES, MEDIA_FLOOD_GLOBAL_THRESHOLD)
+        self.hits = 0
+
+    @staticmethod
+    def _key(*parts) -> int:
+        raw = ":".join(map(str, parts)).encode()
+        return int.from_bytes(hashlib.blake2b(raw, digest_size=8).digest(), "big") or 1 # 0 marks an empty slot
+
+    def observe(self, chat_id: int, user_id: int, unique_id: str, count_global: bool = True) -> Optional[str]:
+        """Counts one posting; returns a spam reason once a threshold is crossed."""
+        now = int(time.time())
+        in_chat = self._chat.bump(self._key(chat_id, unique_id), user_id, now)
+        everywhere = self._global.bump(self._key(unique_id), user_id, now) if count_global else 0
+        if in_chat >= MEDIA_FLOOD_CHAT_THRESHOLD:
+            self.hits += 1
+            return f"posted media that {in_chat}+ users are flooding here"
+        if everywhere >= MEDIA_FLOOD_GLOBAL_THRESHOLD:
+            self.hits += 1
+            return "posted media that is being flooded across groups"
+        return None
+
+    def prune(self):
+        now = int(time.time())
+        self._chat.expire(now)
+        self._global.expire(now)
+
+    def stats_lines(self) -> list[str]:
+        return [
+            f"Media flood index: {len(self._chat)} per-chat / {len(self._global)} global items "
+            f"({self._chat.multi_count() + self._global.multi_count()} multi-poster), {self.hits} hits"
+        ]
+
+media_flood = MediaFloodIndex()
+
+# ================= Recent Message Ring =================
+
+recent_messages: dict[int, deque] = {} # chat_id -> deque of (message_id, user_id, ts)
+
+def record_recent_message(chat_id: int, message_id: int, user_id: int):
+    ring = recent_messages.get(chat_id)
+    if ring is None:
+        ring = recent_messages[chat_id] = deque(maxlen=RECENT_RING_SIZE)
+    ring.append((message_id, user_id, time.time()))
+
+def recent_message_ids(chat_id: int, user_id: Optional[int] = None, since: float = 0, limit: Optional[int] = None) -> list[int]:
+    """Newest-first ids from the ring, optionally for one user and/or newer than `since`."""
+    since = max(since, time.time() - DELETE_MAX_AGE)
+    ids = []
+    for message_id, author_id, ts in reversed(recent_messages.get(chat_id, ())):
+        if ts < since or (limit is not None and len(ids) >= limit):
+            break
+        if user_id is None or author_id == user_id:
+            ids.append(message_id)
+    return ids
+
+def forget_recent_messages(chat_id: int, message_ids: list[int]):
+    ring = recent_messages.get(chat_id)
+    if not ring or not message_ids:
+        return
+    gone = set(message_ids)
+    recent_messages[chat_id] = deque((e for e in ring if e[0] not in gone), maxlen=RECENT_RING_SIZE)
+
+async def purge_messages(bot_, chat_id: int, message_ids: list[int]) -> int:
+    if not message_ids:
+        return 0
+    deleted = await delete_batcher.delete_many(bot_, chat_id, message_ids)
+    forget_recent_messages(chat_id, message_ids)
+    return deleted
+
+async def purge_user_recent(bot_, chat_id: int, user_id: int, minutes: int = SANCTION_PURGE_MINUTES) -> int:
+    """Deletes what `user_id` sent in the last `minutes` (used after bans and mutes)."""
+    if minutes <= 0:
+        return 0
+    ids = recent_message_ids(chat_id, user_id=user_id, since=time.time() - minutes * 60)
+    deleted = await purge_messages(bot_, chat_id, ids)
+    if deleted:
+        logger.info(f"Purged {deleted} recent message(s) from {user_id} in {chat_id}.")
+    return deleted
+
+# ================= Message Author Index =================
+
+class MessageAuthorIndex:
+    """
+    (chat_id, message_id) -> (user_id, first_name) for recent group messages.
+    Writes are buffered and flushed in batches; lookups check the unflushed
+    buffer before the database.
+    """
+    def __init__(self):
+        self._buffer: dict[tuple[int, int], tuple[int, str]] = {}
+        self._flushing: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._buffer) # Unflushed rows
+
+    def record(self, chat_id: int, message_id: int, user: User):
+        self._buffer[(chat_id, message_id)] = (user.id, user.first_name)
+        if len(self._buffer) > AUTHOR_BUFFER_MAX: # DB down for a while: drop the oldest
+            del self._buffer[next(iter(self._buffer))]
+        if len(self._buffer) >= AUTHOR_FLUSH_BATCH:
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        if self._buffer and self._flushing is None and not db.breaker.degraded:
+            # Fresh context: the flush must not inherit the triggering update's deadline
+            self._flushing = asyncio.create_task(self.flush(), context=contextvars.Context())
+
+    async def flush(self):
+        try:
+            while self._buffer:
+                batch = list(self._buffer.items())[:AUTHOR_FLUSH_BATCH]
+                rows = [(c, m, u, n) for (c, m), (u, n) in batch]
+                try:
+                    await db.save_message_authors(rows)
+                except Exception as e:
+                    logger.error(f"Failed to flush {len(rows)} message author(s): {e}")
+                    return # Keep the buffer; the next flush retries
+                for key, _ in batch:
+                    self._buffer.pop(key, None)
+        finally:
+            self._flushing = None
+
+    async def lookup(self, chat_id: int, message_id: int) -> Optional[User]:
+        author = self._buffer.get((chat_id, message_id))
+        if not author:
+            try:
+                author = await db.get_message_author(chat_id, message_id)
+            except db.DatabaseUnavailable:
+                author = None
+        if not author:
+            self.misses += 1
+            return None
+        self.hits += 1
+        user_id, first_name = author
+        return User(id=user_id, first_name=first_name or "User", is_bot=False)
+
+author_index = MessageAuthorIndex()
+
+async def flush_author_index_job(context: ContextTypes.DEFAULT_TYPE):
+    author_index.schedule_flush()
+
+# ================= Update Processor =================
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Runs updates of the same chat (or chat+user) one at a time in arrival
+    order, while different chats run concurrently up to max_concurrent_updates.
+    Chats with pending work take turns round-robin, so one busy group cannot
+    occupy every slot.
+    """
+    def __init__(self, max_concurrent_updates: int, per_user: bool = False):
+        super().__init__(max_concurrent_updates)
+        self.per_user = per_user
+        self._running = 0
+        self._pending: dict[Any, deque] = {}  # key -> waiter futures, oldest first
+        self._ready: deque = deque()          # keys with pending work and nothing in flight
+        self._busy: set = set()               # keys with an update in flight
+        self._chat_stats: dict[Any, list] = {}  # chat -> [processed, total_wait, max_wait]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_update(self, update: object, coroutine):
+        # Skip the base class semaphore: an update parked behind its own chat
+        # must not hold a global slot, or one busy chat could block all others.
+        await self.do_process_update(update, coroutine)
+
+    async def do_process_update(self, update: object, coroutine):
+        key = self._key(update)
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        queued_at = loop.time()
+
+        waiters = self._pending.setdefault(key, deque())
+        waiters.append(waiter)
+        if key not in self._busy and len(waiters) == 1:
+            self._ready.append(key)
+        self._dispatch()
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release(key)  # Slot was granted right before the cancel
+            coroutine.close()
+            raise
+
+        self._record_wait(key, loop.time() - queued_at)
+        try:
+            await coroutine
+        finally:
+            self._release(key)
+
+    def _key(self, update: object):
+        if isinstance(update, Update) and update.effective_chat:
+            chat_id = update.effective_chat.id
+            if self.per_user and update.effective_user:
+                return (chat_id, update.effective_user.id)
+            return chat_id
+        return ("unkeyed", id(update))
+
+    def _dispatch(self):
+        while self._running < self.max_concurrent_updates and self._ready:
+            key = self._ready.popleft()
+            waiters = self._pending.get(key)
+            while waiters and waiters[0].cancelled():
+                waiters.popleft()
+            if not waiters:
+                self._pending.pop(key, None)
+                continue
+            self._busy.add(key)
+            self._running += 1
+            waiters.popleft().set_result(None)
+
+    def _release(self, key):
+        self._running -= 1
+        self._busy.discard(key)
+        if self._pending.get(key):
+            self._ready.append(key)  # Back of the line: other chats go first
+        else:
+            self._pending.pop(key, None)
+        self._dispatch()
+
+    @staticmethod
+    def _stats_key(key):
+        chat_id = key[0] if isinstance(key, tuple) else key
+        if not isinstance(chat_id, int):
+            return "other"
+        return chat_id if chat_id < 0 else "private" # Don't keep one entry per DM user
+
+    def _record_wait(self, key, waited: float):
+        stats = self._chat_stats.setdefault(self._stats_key(key), [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+
+    def queue_depths(self) -> dict:
+        depths: dict = {}
+        for key, waiters in self._pending.items():
+            if waiters:
+                chat = self._stats_key(key)
+                depths[chat] = depths.get(chat, 0) + len(waiters)
+        return depths
+
+    def stats_lines(self) -> list[str]:
+        depths = self.queue_depths()
+        lines = [
+            f"In flight: {self._running}/{self.max_concurrent_updates} | Waiting: {sum(depths.values())} "
+            f"in {len(depths)} chats (ordering: {'chat+user' if self.per_user else 'chat'})"
+        ]
+        for chat, depth in sorted(depths.items(), key=lambda kv: kv[1], reverse=True)[:5]:
+            lines.append(f"• <code>{chat}</code> queued {depth}")
+        slowest = sorted(self._chat_stats.items(), key=lambda kv: kv[1][2], reverse=True)[:5]
+        for chat, (count, total, worst) in slowest:
+            lines.append(f"• <code>{chat}</code> {count} upd, wait avg {total / count * 1000:.0f}ms / max {worst * 1000:.0f}ms")
+        return lines
+
+def is_degraded() -> bool:
+    """True while the backlog is high; non-critical work (stats, reputation) is skipped."""
+    return ingest_queue.degraded
+
 # ================= Flask App & Bot Setup =================
 app = Flask(__name__)
-application = ApplicationBuilder().token(TOKEN).concurrent_updates(True).build()
+ingest_queue = IngestQueue(UPDATE_QUEUE_MAX)
+update_processor = ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY, per_user=UPDATE_ORDERING == "chat_user")
+rate_limiter = PriorityRateLimiter()
+application = (
+    ApplicationBuilder().token(TOKEN)
+    .update_queue(ingest_queue)
+    .concurrent_updates(update_processor)
+    .rate_limiter(rate_limiter)
+    .build()
+)
 bot = application.bot 
 
 # ================= File Download/Join Check Logic =================
 
+async def _is_channel_member(channel_id: int, user_id: int) -> bool:
+    try:
+        member = await bot.get_chat_member(channel_id, user_id)
+        return member.status in MEMBER_STATUSES
+    except TelegramError as e:
+        logger.error(f"Error checking {channel_id} for user {user_id}: {e}")
+        return False
+
 async def is_member_all(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
-    """Checks if a user is a member of all required channels."""
-    for ch in CHANNELS:
-        try:
-            member = await bot.get_chat_member(ch, user_id) 
-            if member.status not in ["member", "administrator", "creator", "restricted"]:
-                return False
-        except TelegramError as e: 
-            logger.error(f"Error checking {ch} for user {user_id}: {e}")
-            return False
-    return True
+    """Checks if a user is a member of all required channels (concurrently, cached when verified)."""
+    if join_verified.get(user_id, 0) > time.time():
+        return True
+    # Only positive results are cached: a user who just joined must pass on the next click.
+    results = await asyncio.gather(*(_is_channel_member(ch, user_id) for ch in CHANNELS))
+    if all(results):
+        join_verified[user_id] = time.time() + JOIN_VERIFIED_TTL
+        return True
+    return False
 
 async def send_join_message(update: Update, context: ContextTypes.DEFAULT_TYPE, is_callback=False):
     """Sends the message prompting the user to join channels."""
@@ -1327,22 +3202,44 @@ async def send_join_message(update: Update, context: ContextTypes.DEFAULT_TYPE,
                 caption=caption, reply_markup=reply_markup
             )
         except TelegramError: 
-             await update.callback_query.message.reply_photo(
-                 photo=JOIN_IMAGE, caption=caption, reply_markup=reply_markup
+             await media_registry.send(
+                 "join_image", update.callback_query.message.reply_photo, "photo",
+                 caption=caption, reply_markup=reply_markup
              )
     elif update.message:
-        await update.message.reply_photo(
-            photo=JOIN_IMAGE, caption=caption, reply_markup=reply_markup
+        await media_registry.send(
+            "join_image", update.message.reply_photo, "photo",
+            caption=caption, reply_markup=reply_markup
         )
 
 # ================= Handlers =================
 
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Turns DB outages in commands/buttons into a short reply; logs everything else."""
+    if not isinstance(context.error, db.DatabaseUnavailable):
+        logger.error("Unhandled error while processing an update", exc_info=context.error)
+        return
+    logger.warning(f"DB unavailable while handling an update: {context.error}")
+    if not isinstance(update, Update): return
+    notice = "⚠️ Database temporarily unavailable, try again shortly."
+    try:
+        if update.callback_query:
+            await update.callback_query.answer(notice, show_alert=True)
+        elif update.effective_message and update.effective_message.text and update.effective_message.text.startswith("/"):
+            await update.effective_message.reply_text(notice, rate_limit_args=PRIORITY_INTERACTIVE)
+    except TelegramError: pass
+
 async def periodic_cleanup_job(context: ContextTypes.DEFAULT_TYPE):
     """JobQueue function to periodically clean expired warnings and flood cache."""
     global user_behavior
     
-    # 1. Clean expired warnings from DB
-    await db.clean_expired_warnings_async()
+    # 1. Clean expired warnings from DB (skipped during an outage; the in-memory steps still run)
+    try:
+        expired = await db.clean_expired_warnings_async()
+        if expired:
+            logger.info(f"Removed {expired} expired warnings.")
+    except db.DatabaseUnavailable as e:
+        logger.warning(f"Expired warning cleanup skipped: {e}")
 
     # 2. Clean in-memory flood cache
     now = time.time()
@@ -1367,6 +3264,34 @@ async def periodic_cleanup_job(context: ContextTypes.DEFAULT_TYPE):
     expired_rep_keys = [k for k, t in rep_cooldowns.items() if t < one_hour_ago]
     for k in expired_rep_keys:
         del rep_cooldowns[k]
+
+    tg_lookup.prune()
+    notice_aggregator.prune()
+    join_guard.prune()
+    media_flood.prune()
+    try:
+        await blocklist.refresh(full=True) # Picks up removals made by other instances
+    except db.DatabaseUnavailable as e:
+        logger.warning(f"Blocklist reload skipped: {e}")
+
+    # 4. Expire the message author index
+    try:
+        pruned_authors = await db.clean_message_authors(AUTHOR_INDEX_RETENTION_HOURS)
+        if pruned_authors:
+            logger.info(f"Removed {pruned_authors} message author index rows.")
+    except db.DatabaseUnavailable as e:
+        logger.warning(f"Author index cleanup skipped: {e}")
+
+    # 5. Clean in-memory fallback warnings
+    utc_now = datetime.now(timezone.utc)
+    for key in [k for k, (_, expiry) in fallback_warnings.items() if expiry < utc_now]:
+        del fallback_warnings[key]
+
+    # 6. Clean join-gate caches
+    for uid in [u for u, until in join_verified.items() if until < now]:
+        del join_verified[uid]
+    for uid in [u for u, (clicked_at, _) in join_clicks.items() if now - clicked_at > JOIN_CLICK_DEBOUNCE]:
+        del join_clicks[uid]
         
     logger.info(f"Cleaned cleanup job. Removed {len(expired_rep_keys)} old rep cooldowns.")
 
@@ -1385,7 +3310,8 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     if not query: return
     data = query.data
-    await query.answer()
+    if data != "done": # "done" answers with its own text below (a query can only be answered once)
+        await query.answer()
     # --- NTF SELECTION HANDLER ---
     if data.startswith("ntf_sel_"):
         if data == "ntf_sel_cancel":
@@ -1444,9 +3370,11 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 until = datetime.now() + timedelta(hours=24)
                 await context.bot.restrict_chat_member(c_id, u_id, ChatPermissions(can_send_messages=False), until_date=until)
                 await query.message.edit_text("✅ Muted 24h")
+                context.application.create_task(after_sanction(context.bot, c_id, u_id))
             elif "ban" in action:
                 await context.bot.ban_chat_member(c_id, u_id)
                 await query.message.edit_text("✅ Banned")
+                context.application.create_task(after_sanction(context.bot, c_id, u_id, "banned from report"))
         except Exception as e:
             await query.message.edit_text(f"❌ Error: {e}")
         return
@@ -1454,7 +3382,22 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # ================= 1. Done / Verified (File Gating) =================
     if data == "done":
         user_id = query.from_user.id
-        if await is_member_all(context, user_id):
+        now = time.time()
+
+        # Debounce button mashing: answer repeats from the last result
+        last_click = join_clicks.get(user_id)
+        if last_click:
+            clicked_at, was_member = last_click
+            if now - clicked_at < (JOIN_CLICK_DEBOUNCE if was_member else JOIN_RETRY_DEBOUNCE):
+                if was_member:
+                    await query.answer("✅ Already sent! Check the messages above.")
+                else:
+                    await query.answer("⚠️ You must join all channels and groups to download the file.", show_alert=True)
+                return
+
+        is_member = await is_member_all(context, user_id)
+        join_clicks[user_id] = (now, is_member)
+        if is_member:
             await query.answer(text="Verifying...", show_alert=False)
             if query.message:
                 try: await query.message.delete()
@@ -1474,7 +3417,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             # 2. Try to send File (With Crash Protection)
             try:
-                await context.bot.send_document(chat_id=chat_id, document=FILE_PATH)
+                await media_registry.send("gated_file", context.bot.send_document, "document", chat_id=chat_id)
             except BadRequest:
                 # This runs if the ID is wrong, instead of crashing the bot
                 await context.bot.send_message(chat_id=chat_id, text="⚠️ **Error:** The file has expired or is invalid.\nPlease contact the admin.")
@@ -1495,7 +3438,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = int(user_id_str)
 
         try:
-            member_status = await bot.get_chat_member(chat_id, query.from_user.id) 
+            member_status = await tg_lookup.get_chat_member(context.bot, chat_id, query.from_user.id)
             if member_status.status not in (ChatMember.ADMINISTRATOR, ChatMember.OWNER):
                 await query.answer("You are not authorized.", show_alert=True)
                 return
@@ -1518,9 +3461,11 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     chat_id=chat_id, user_id=user_id, only_if_banned=True
                 )
              except TelegramError as e: logger.error(f"Failed to unban {user_id}: {e}")
+        if action in ("unmute", "unban"):
+            await blocklist.remove(user_id, chat_id) # Reversed by an admin: no longer enforced in this chat
                 
         try:
-            user_to_act = await context.bot.get_chat_member(chat_id, user_id)
+            user_to_act = await tg_lookup.get_chat_member(context.bot, chat_id, user_id)
             user_display = f"<a href='tg://user?id={user_id}'>{html.escape(user_to_act.user.first_name)}</a>"
         except TelegramError:
             user_display = f"User ID <code>{user_id}</code>"
@@ -1536,254 +3481,227 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 new_text = f"🔓 {user_display} has been unbanned. User can rejoin."
             
             if new_text:
+                # Raid summaries carry several users' buttons: only this one is resolved
+                status = f"{new_text} (<code>{current_time}</code>)"
+                if await notice_aggregator.resolve(context.bot, query.message, data, status):
+                    return
+                rows = query.message.reply_markup.inline_keyboard if query.message.reply_markup else ()
                 try:
-                    await query.message.edit_text(
-                        text=f"{new_text}\n• Action by: Admin\n• Time: <code>{current_time}</code>",
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=None
-                    )
+                    if sum(len(row) for row in rows) > 1: # Summary from before a restart
+                        remaining = [[b for b in row if b.callback_data != data] for row in rows]
+                        remaining = [row for row in remaining if row]
+                        await query.message.edit_text(
+                            text=f"{query.message.text_html}\n{status}",
+                            parse_mode=ParseMode.HTML,
+                            reply_markup=InlineKeyboardMarkup(remaining) if remaining else None
+                        )
+                    else:
+                        await query.message.edit_text(
+                            text=f"{new_text}\n• Action by: Admin\n• Time: <code>{current_time}</code>",
+                            parse_mode=ParseMode.HTML,
+                            reply_markup=None
+                        )
                 except TelegramError as e:
                     logger.warning(f"Failed to edit button message: {e}")
 
 # --- HELPER FOR LINK PARSING (Reused in commands) ---
+def _link_match_ids(match: re.Match) -> tuple[Any, int]:
+    chat_identifier = match.group(1)
+    message_id = int(match.group(2))
+    if chat_identifier.isdigit():
+        return int(f"-100{chat_identifier}"), message_id
+    return f"@{chat_identifier}", message_id
+
 def _parse_link_identifiers(link: str) -> Optional[tuple[Any, int]]:
     """
     Parses a telegram message link to extract chat ID and message ID.
     Returns (chat_id, message_id) or None.
     """
-    link_pattern = r"(?:https?://)?(?:www\.)?t\.me/(?:c/)?(\d+|[\w\d_]+)/(\d+)"
-    match = re.search(link_pattern, link)
-    if not match:
-        return None
-
-    chat_identifier = match.group(1)
-    message_id = int(match.group(2))
+    match = MESSAGE_LINK_REGEX.search(link)
+    return _link_match_ids(match) if match else None
+
+def _find_link_identifiers(text: str) -> list[tuple[Any, int]]:
+    """All distinct (chat_id, message_id) pairs linked in `text`, in order."""
+    return list(dict.fromkeys(_link_match_ids(m) for m in MESSAGE_LINK_REGEX.finditer(text)))
+
+def _split_leading_links(text: str) -> tuple[list[tuple[Any, int]], str]:
+    """Splits "<link> <link> ... rest of text" into the links and the rest (newlines kept)."""
+    links = []
+    rest = text.lstrip()
+    while rest:
+        token = rest.split(None, 1)[0]
+        match = MESSAGE_LINK_REGEX.match(token)
+        # Allow ?single, ?comment=3, #..., a trailing slash; anything else means the text has started
+        if not match or token[match.end():match.end() + 1] not in ("", "?", "#", "/"):
+            break
+        links.append(_link_match_ids(match))
+        rest = rest[len(token):].lstrip()
+    return list(dict.fromkeys(links)), rest
+
+async def _links_from_replied_file(message: Message) -> list[tuple[Any, int]]:
+    """Links listed in a document the command replies to (one admin pasting a whole incident)."""
+    reply = message.reply_to_message
+    if not reply or not reply.document:
+        return []
+    if reply.document.file_size and reply.document.file_size > BULK_LINK_FILE_MAX:
+        await message.reply_text("❌ That file is too large for a link list.")
+        return []
+    tg_file = await reply.document.get_file()
+    content = await tg_file.download_as_bytearray()
+    return _find_link_identifiers(content.decode("utf-8", errors="ignore"))
+
+async def _is_admin_of(bot_, chat_id, user_id: int) -> bool:
+    try:
+        member = await tg_lookup.get_chat_member(bot_, chat_id, user_id)
+        return member.status in ADMIN_STATUSES
+    except TelegramError:
+        return False
 
-    if chat_identifier.isdigit():
-        return int(f"-100{chat_identifier}"), message_id
-    else:
-        return f"@{chat_identifier}", message_id
+async def run_link_batch(update: Update, context: ContextTypes.DEFAULT_TYPE, links: list, operation, done_label: str, concurrency: int = BULK_LINK_CONCURRENCY):
+    """
+    Runs operation(chat_id, message_id) for every link: one admin check per
+    distinct chat, at most `concurrency` calls in flight, then a single summary reply.
+    """
+    msg = update.effective_message
+    ignored = max(len(links) - BULK_LINK_MAX, 0)
+    links = links[:BULK_LINK_MAX]
+    chats = list(dict.fromkeys(chat_id for chat_id, _ in links))
+    verdicts = await asyncio.gather(*(_is_admin_of(context.bot, c, update.effective_user.id) for c in chats))
+    allowed = {c for c, ok in zip(chats, verdicts) if ok}
+
+    gate = asyncio.Semaphore(concurrency)
+    async def run_one(chat_id, message_id) -> Optional[str]:
+        if chat_id not in allowed:
+            return "not an admin there (or I cannot access that chat)"
+        async with gate:
+            try:
+                await operation(chat_id, message_id)
+                return None
+            except TelegramError as e:
+                return str(e)
+    errors = await asyncio.gather(*(run_one(c, m) for c, m in links))
+
+    failed = [(c, m, err) for (c, m), err in zip(links, errors) if err]
+    lines = [f"{'✅' if not failed else '⚠️'} {done_label}: {len(links) - len(failed)}/{len(links)}"]
+    for chat_id, message_id, err in failed[:10]:
+        lines.append(f"• <code>{html.escape(str(chat_id))}/{message_id}</code>: {html.escape(err)}")
+    if len(failed) > 10:
+        lines.append(f"• …and {len(failed) - 10} more")
+    if ignored:
+        lines.append(f"ℹ️ {ignored} link(s) beyond the limit of {BULK_LINK_MAX} were ignored.")
+    await msg.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
 
 
 # --- REPLY TO COMMAND (NEW) ---
 async def reply_to_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Replies to a specific message link with text."""
+    """Replies to one or more message links with text."""
     # FIX: Check raw text length first to avoid errors
     if not update.message.text: 
         return
 
-    # FIX: Split the raw message text into exactly 3 parts:
-    # 0: /replyto
-    # 1: link
-    # 2: The rest of the message (preserves newlines/formatting)
-    parts = update.message.text.split(None, 2)
+    # Everything after /replyto: leading links, then the text (keeps your line breaks!)
+    parts = update.message.text.split(None, 1)
+    links, text_to_send = _split_leading_links(parts[1] if len(parts) > 1 else "")
+    links = links or await _links_from_replied_file(update.message)
 
-    if len(parts) < 3:
-        await update.message.reply_text("Usage: `/replyto <link> <text>`", parse_mode=ParseMode.MARKDOWN)
+    if not links or not text_to_send:
+        await update.message.reply_text("Usage: `/replyto <link> [link ...] <text>`", parse_mode=ParseMode.MARKDOWN)
         return
 
-    link = parts[1]
-    text_to_send = parts[2] # This variable now keeps your line breaks!
-    user = update.effective_user
-
-    ids = _parse_link_identifiers(link)
-    if not ids:
-        await update.message.reply_text("❌ Invalid link format.")
-        return
-    final_chat_id, message_id = ids
-
-    try:
-        member = await context.bot.get_chat_member(chat_id=final_chat_id, user_id=user.id)
-        if member.status not in ["administrator", "creator", "owner"]:
-            await update.message.reply_text("⛔ You must be an Admin of that chat to use this.")
-            return
-    except TelegramError:
-        await update.message.reply_text("❌ I cannot access that chat.")
-        return
-
-    try:
-        await context.bot.send_message(chat_id=final_chat_id, text=text_to_send, reply_to_message_id=message_id)
-        await update.message.reply_text("✅ Reply sent successfully.")
-    except TelegramError as e:
-        await update.message.reply_text(f"❌ Failed to reply: {e}")
+    async def send_reply(chat_id, message_id):
+        await context.bot.send_message(chat_id=chat_id, text=text_to_send, reply_to_message_id=message_id)
+    await run_link_batch(update, context, links, send_reply, "Replies sent")
 
 
 # --- REACT COMMAND (NEW) ---
 async def react_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Reacts to a specific message link with an emoji."""
-    if not context.args or len(context.args) < 2:
-        await update.message.reply_text("Usage: `/react <link> <emoji>`", parse_mode=ParseMode.MARKDOWN)
-        return
-    link = context.args[0]
-    emoji_to_set = context.args[1]
-    user = update.effective_user
-
-    ids = _parse_link_identifiers(link)
-    if not ids:
-        await update.message.reply_text("❌ Invalid link format.")
+    """Reacts to one or more message links with an emoji."""
+    args = context.args or []
+    links = _find_link_identifiers(" ".join(args))
+    emojis = [a for a in args if not MESSAGE_LINK_REGEX.search(a)]
+    if emojis and not links:
+        links = await _links_from_replied_file(update.message)
+    if not links or not emojis:
+        await update.message.reply_text("Usage: `/react <link> [link ...] <emoji>`", parse_mode=ParseMode.MARKDOWN)
         return
-    final_chat_id, message_id = ids
+    emoji_to_set = emojis[0]
 
-    try:
-        member = await context.bot.get_chat_member(chat_id=final_chat_id, user_id=user.id)
-        if member.status not in ["administrator", "creator", "owner"]:
-            await update.message.reply_text("⛔ You must be an Admin of that chat to use this.")
-            return
-    except TelegramError:
-        await update.message.reply_text("❌ I cannot access that chat.")
-        return
-
-    try:
-        await context.bot.set_message_reaction(chat_id=final_chat_id, message_id=message_id, reaction=[ReactionTypeEmoji(emoji=emoji_to_set)])
-        await update.message.reply_text(f"✅ Reacted with {emoji_to_set}")
-    except TelegramError as e:
-        await update.message.reply_text(f"❌ Failed: {e}")
+    async def react(chat_id, message_id):
+        await context.bot.set_message_reaction(chat_id=chat_id, message_id=message_id, reaction=[ReactionTypeEmoji(emoji=emoji_to_set)])
+    await run_link_batch(update, context, links, react, f"Reacted with {emoji_to_set}")
 
 # --- UNREACT COMMAND ---
 async def unreact_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Removes reaction from a message."""
-    if not context.args:
-        await update.message.reply_text("Usage: `/unreact <message_link>`", parse_mode=ParseMode.MARKDOWN)
+    """Removes reactions from one or more messages."""
+    links = _find_link_identifiers(" ".join(context.args or [])) or await _links_from_replied_file(update.message)
+    if not links:
+        await update.message.reply_text("Usage: `/unreact <message_link> [link ...]`", parse_mode=ParseMode.MARKDOWN)
         return
-    link = context.args[0]
-    user = update.effective_user
-    
-    ids = _parse_link_identifiers(link)
-    if not ids:
-        await update.message.reply_text("❌ Invalid link format.")
-        return
-    final_chat_id, message_id = ids
 
-    try:
-        member = await context.bot.get_chat_member(chat_id=final_chat_id, user_id=user.id)
-        if member.status not in ["administrator", "creator", "owner"]:
-            await update.message.reply_text("⛔ You must be an Admin to use this.")
-            return 
-    except TelegramError:
-        await update.message.reply_text("❌ I cannot access that chat.")
-        return
-
-    try:
-        await context.bot.set_message_reaction(chat_id=final_chat_id, message_id=message_id, reaction=[])
-        await update.message.reply_text("✅ Reaction removed.")
-    except TelegramError as e:
-        await update.message.reply_text(f"❌ Failed: {e}")
+    async def unreact(chat_id, message_id):
+        await context.bot.set_message_reaction(chat_id=chat_id, message_id=message_id, reaction=[])
+    await run_link_batch(update, context, links, unreact, "Reactions removed")
 
 
 # --- EDIT MESSAGE COMMAND ---
 async def edit_message_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Edits a message sent by the bot via its link.
-    Usage: /edit <link> <new_text>
+    Edits messages sent by the bot via their links.
+    Usage: /edit <link> [link ...] <new_text>
     """
     # FIX: Check raw text length first
     if not update.message.text: 
         return
 
-    # FIX: Split the raw message text into exactly 3 parts
-    parts = update.message.text.split(None, 2)
-
-    if len(parts) < 3:
-        await update.message.reply_text("Usage: `/edit <link> <new_text>`", parse_mode=ParseMode.MARKDOWN)
-        return
-
-    link = parts[1]
-    new_text = parts[2] # This preserves newlines!
-    user = update.effective_user
+    parts = update.message.text.split(None, 1)
+    links, new_text = _split_leading_links(parts[1] if len(parts) > 1 else "") # new_text preserves newlines!
+    links = links or await _links_from_replied_file(update.message)
 
-    ids = _parse_link_identifiers(link)
-    if not ids:
-        await update.message.reply_text("❌ Invalid link format.")
-        return
-    final_chat_id, message_id = ids
-
-    # Security Check
-    try:
-        member = await context.bot.get_chat_member(chat_id=final_chat_id, user_id=user.id)
-        if member.status not in ["administrator", "creator", "owner"]:
-            await update.message.reply_text("⛔ You must be an Admin to use this.")
-            return
-    except TelegramError:
-        await update.message.reply_text("❌ I cannot access that chat.")
+    if not links or not new_text:
+        await update.message.reply_text("Usage: `/edit <link> [link ...] <new_text>`", parse_mode=ParseMode.MARKDOWN)
         return
 
-    try:
-        await context.bot.edit_message_text(chat_id=final_chat_id, message_id=message_id, text=new_text)
-        await update.message.reply_text("✅ Message edited successfully.")
-    except TelegramError as e:
-        if "message to edit not found" in str(e).lower():
-            await update.message.reply_text("❌ Failed. (I can only edit messages *I* sent).")
-        else:
-            await update.message.reply_text(f"❌ Failed to edit: {e}")
+    async def edit(chat_id, message_id):
+        try:
+            await context.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=new_text)
+        except BadRequest as e:
+            if "message to edit not found" in str(e).lower() or "can't be edited" in str(e).lower():
+                raise BadRequest("I can only edit messages I sent") from e
+            raise
+    await run_link_batch(update, context, links, edit, "Messages edited")
 
 # --- DELETE MESSAGE COMMAND (RECOMMENDED NEW FEATURE) ---
 async def delete_message_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Deletes a message via its link.
-    Usage: /del <link>
+    Deletes messages via their links.
+    Usage: /del <link> [link ...]  (or reply to a file of links)
     """
-    if not context.args:
-        await update.message.reply_text("Usage: `/del <link>`", parse_mode=ParseMode.MARKDOWN)
+    links = _find_link_identifiers(" ".join(context.args or [])) or await _links_from_replied_file(update.message)
+    if not links:
+        await update.message.reply_text("Usage: `/del <link> [link ...]`", parse_mode=ParseMode.MARKDOWN)
         return
-    link = context.args[0]
-    user = update.effective_user
 
-    ids = _parse_link_identifiers(link)
-    if not ids:
-        await update.message.reply_text("❌ Invalid link format.")
-        return
-    final_chat_id, message_id = ids
-
-    # Security Check
-    try:
-        member = await context.bot.get_chat_member(chat_id=final_chat_id, user_id=user.id)
-        if member.status not in ["administrator", "creator", "owner"]:
-            await update.message.reply_text("⛔ You must be an Admin to use this.")
-            return
-    except TelegramError:
-        await update.message.reply_text("❌ I cannot access that chat.")
-        return
-
-    try:
-        await context.bot.delete_message(chat_id=final_chat_id, message_id=message_id)
-        await update.message.reply_text("✅ Message deleted.")
-    except TelegramError as e:
-        await update.message.reply_text(f"❌ Failed to delete: {e}")
+    async def delete(chat_id, message_id):
+        if not await delete_batcher.delete(context.bot, chat_id, message_id):
+            raise TelegramError("delete failed")
+    # Deletes merge into deleteMessages batches per chat, so allow a full batch in flight
+    await run_link_batch(update, context, links, delete, "Messages deleted", concurrency=DELETE_BATCH_MAX)
 
 
 # --- PIN MESSAGE COMMAND (RECOMMENDED NEW FEATURE) ---
 async def pin_message_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Pins a message via its link.
-    Usage: /pin <link>
+    Pins messages via their links.
+    Usage: /pin <link> [link ...]
     """
-    if not context.args:
-        await update.message.reply_text("Usage: `/pin <link>`", parse_mode=ParseMode.MARKDOWN)
-        return
-    link = context.args[0]
-    user = update.effective_user
-
-    ids = _parse_link_identifiers(link)
-    if not ids:
-        await update.message.reply_text("❌ Invalid link format.")
+    links = _find_link_identifiers(" ".join(context.args or [])) or await _links_from_replied_file(update.message)
+    if not links:
+        await update.message.reply_text("Usage: `/pin <link> [link ...]`", parse_mode=ParseMode.MARKDOWN)
         return
-    final_chat_id, message_id = ids
 
-    # Security Check
-    try:
-        member = await context.bot.get_chat_member(chat_id=final_chat_id, user_id=user.id)
-        if member.status not in ["administrator", "creator", "owner"]:
-            await update.message.reply_text("⛔ You must be an Admin to use this.")
-            return
-    except TelegramError:
-        await update.message.reply_text("❌ I cannot access that chat.")
-        return
-
-    try:
-        await context.bot.pin_chat_message(chat_id=final_chat_id, message_id=message_id)
-        await update.message.reply_text("✅ Message pinned.")
-    except TelegramError as e:
-        await update.message.reply_text(f"❌ Failed to pin: {e}")
+    async def pin(chat_id, message_id):
+        await context.bot.pin_chat_message(chat_id=chat_id, message_id=message_id, disable_notification=len(links) > 1)
+    await run_link_batch(update, context, links, pin, "Messages pinned")
 
 
 # --- UPDATED PRIVATE REACTION HANDLER ---
@@ -1801,9 +3719,8 @@ async def handle_private_reaction(update: Update, context: ContextTypes.DEFAULT_
         return
     user = update.effective_user
     
-    # Re-use parser logic (simplified for this handler since we need the match object too)
-    link_pattern = r"(?:https?://)?(?:www\.)?t\.me/(?:c/)?(\d+|[\w\d_]+)/(\d+)"
-    match = re.search(link_pattern, text)
+    # Shared link regex (we need the match object too, to strip the link from the text)
+    match = MESSAGE_LINK_REGEX.search(text)
 
     if not match:
         # User sent regular text like "hi" or "give file"
@@ -1812,22 +3729,10 @@ async def handle_private_reaction(update: Update, context: ContextTypes.DEFAULT_
         await send_join_message(update, context)
         return
 
-    # Extract Chat ID
-    chat_identifier = match.group(1)
-    message_id = int(match.group(2))
-    
-    final_chat_id = None
-    if chat_identifier.isdigit():
-        final_chat_id = int(f"-100{chat_identifier}")
-    else:
-        final_chat_id = f"@{chat_identifier}"
+    final_chat_id, message_id = _link_match_ids(match)
 
     # Security Check (Silent fail if not admin)
-    try:
-        member = await context.bot.get_chat_member(chat_id=final_chat_id, user_id=user.id)
-        if member.status not in ["administrator", "creator", "owner"]:
-            return 
-    except TelegramError:
+    if not await _is_admin_of(context.bot, final_chat_id, user.id):
         return
 
     # Detect Reaction
@@ -1851,6 +3756,26 @@ async def handle_private_reaction(update: Update, context: ContextTypes.DEFAULT_
     except TelegramError as e:
         await update.message.reply_text(f"❌ **Failed.**\nTelegram rejected '{selected_reaction}'.\nMake sure it is a valid single emoji.")
 
+# --- CHAT MEMBER UPDATES ---
+async def chat_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Keeps member-derived caches current from chat_member events."""
+    change = update.chat_member
+    if not change:
+        return
+    chat_id = change.chat.id
+    user_id = change.new_chat_member.user.id
+    tg_lookup.put_member(chat_id, change.new_chat_member)
+
+    # Leaving a gated channel revokes the cached join verification
+    if chat_id in CHANNEL_DATA and change.new_chat_member.status not in MEMBER_STATUSES:
+        join_verified.pop(user_id, None)
+        join_clicks.pop(user_id, None)
+
+    was_admin = change.old_chat_member.status in ADMIN_STATUSES
+    is_admin_now = change.new_chat_member.status in ADMIN_STATUSES
+    if was_admin != is_admin_now:
+        await apply_admin_change(chat_id, user_id, is_admin_now)
+
 # --- MESSAGE HANDLER ---
 
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1863,11 +3788,18 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # --- Status Updates (Join/Left) - Only check these on NEW messages ---
     if update.message and (update.message.new_chat_members or update.message.left_chat_member):
         if update.message.new_chat_members:
+            humans = []
             for member in update.message.new_chat_members:
                 if member.is_bot and member.id != context.bot.id:
                     try:
-                        await context.bot.ban_chat_member(current_msg.chat_id, member.id)
+                        await context.bot.ban_chat_member(current_msg.chat_id, member.id, rate_limit_args=PRIORITY_MODERATION)
                     except TelegramError: pass
+                elif blocklist.blocks(current_msg.chat_id, member.id):
+                    await blocklist.enforce(context.bot, current_msg.chat_id, member.id)
+                elif not member.is_bot:
+                    humans.append(member.id)
+            if humans:
+                await join_guard.observe(context.bot, current_msg.chat_id, humans)
         try: 
             await current_msg.delete()
         except TelegramError: pass
@@ -1882,10 +3814,27 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if not user or not chat: return
 
+    # Shared blocklist first: two set lookups, no DB/ML work on a hit
+    # Rare path, so confirm admin status properly rather than trusting a possibly cold cache
+    if blocklist.blocks(chat.id, user.id) and user.id not in await get_admin_ids(chat, context):
+        await blocklist.enforce(context.bot, chat.id, user.id, current_msg.message_id)
+        return
+
+    # Bound every DB call made for this update (spam pipeline included)
+    if UPDATE_DEADLINE > 0:
+        db.update_deadline.set(asyncio.get_running_loop().time() + UPDATE_DEADLINE)
+
+    if update.message and chat.type in [ChatType.GROUP, ChatType.SUPERGROUP]:
+        record_recent_message(chat.id, current_msg.message_id, user.id)
+        author_index.record(chat.id, current_msg.message_id, user)
+
     # === Activity & Reputation (Skip for Edits) ===
     # We only increment stats for NEW messages, not every time they edit a typo.
-    if update.message and chat.type in [ChatType.GROUP, ChatType.SUPERGROUP]:
-        await db.increment_total_messages(chat.id, user.id)
+    # Under backlog (degraded mode) stats are skipped so moderation keeps up.
+    if update.message and chat.type in [ChatType.GROUP, ChatType.SUPERGROUP] and not is_degraded():
+        total = await noncritical_write(db.increment_total_messages(chat.id, user.id))
+        if total:
+            activity_board.observe(chat.id, user.id, total, user.first_name)
         
         # Check for Reply + Keyword
         if current_msg.reply_to_message:
@@ -1902,7 +3851,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         return 
                     
                     rep_cooldowns[cooldown_key] = current_time
-                    await db.add_reputation(ref.id, 1)
+                    await noncritical_write(db.add_reputation(ref.id, 1))
  
     if user.id in SYSTEM_BOT_IDS: return
         
@@ -1917,16 +3866,18 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update_user_activity(chat.id, user.id) 
 
     async def handle_spam(reason_text: str):
-        try: await current_msg.delete() # Delete the actual message (new or edited)
-        except TelegramError as e: logger.error(f"Failed to delete message: {e}")
-        
-        warn_count, expiry_dt = await db.add_warning_async(chat.id, user.id)
+        # The delete is queued first and not awaited: the chat's next update can run and
+        # add its own id to the same deleteMessages batch.
+        delete_batcher.delete_detached(context.bot, chat.id, current_msg.message_id, time.monotonic())
+
+        warn_count, expiry_dt = await add_warning_failopen(chat.id, user.id)
         expiry_str = expiry_dt.strftime("%d/%m/%Y %H:%M")
         
         user_mention = f"<a href='tg://user?id={user.id}'>{html.escape(user.first_name)}</a>"
         user_display = f"{user_mention} [<code>{user.id}</code>]"
         keyboard = None
         caption = ""
+        actions = []
 
         if warn_count <= 2:
             caption = (
@@ -1934,46 +3885,289 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"Action: Warn ({warn_count}/3) ❕ until {expiry_str}."
             )
             keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data=f"cancel_warn:{chat.id}:{user.id}")]]
+            summary_line = f"{user_display} {html.escape(reason_text)} → Warn ({warn_count}/3)"
+            summary_button = InlineKeyboardButton(f"❌ {user.first_name[:16]}", callback_data=f"cancel_warn:{chat.id}:{user.id}")
         else:
             caption = (
                 f"{user_display} has exceeded the warning limit.\n"
                 f"Action: Muted ({warn_count}/3) 🔇 until {expiry_str}."
             )
             keyboard = [[InlineKeyboardButton("✅ Unmute", callback_data=f"unmute:{chat.id}:{user.id}")]]
+            summary_line = f"{user_display} {html.escape(reason_text)} → Muted ({warn_count}/3) 🔇"
+            summary_button = InlineKeyboardButton(f"✅ Unmute {user.first_name[:12]}", callback_data=f"unmute:{chat.id}:{user.id}")
             
             until_date = datetime.now() + timedelta(days=1)
-            try:
-                await context.bot.restrict_chat_member(
-                    chat_id=chat.id, user_id=user.id,
-                    permissions=ChatPermissions(can_send_messages=False),
-                    until_date=until_date
-                )
-            except TelegramError as e: logger.error(f"Failed to mute user {user.id}: {e}")
+            async def mute():
+                try:
+                    await context.bot.restrict_chat_member(
+                        chat_id=chat.id, user_id=user.id,
+                        permissions=ChatPermissions(can_send_messages=False),
+                        until_date=until_date, rate_limit_args=PRIORITY_MODERATION
+                    )
+                except TelegramError as e: logger.error(f"Failed to mute user {user.id}: {e}")
+            actions.append(mute())
+            actions.append(after_sanction(context.bot, chat.id, user.id, "3/3 spam warnings"))
         
         reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
-        try:
-            await context.bot.send_message(
-                chat_id=chat.id, text=caption,
-                reply_markup=reply_markup, parse_mode=ParseMode.HTML
-            )
-        except TelegramError as e: logger.error(f"Failed to send warning message: {e}")
+        # Posted as-is normally, folded into a raid summary when the chat is under attack; either
+        # way it goes out in the background so a rate-limited notice doesn't stall this chat's updates
+        await notice_aggregator.notify(context.bot, chat.id, caption, reply_markup, summary_line, summary_button)
+
+        await asyncio.gather(*actions)
+
+    # Same media repeated in this chat or across chats (no download needed)
+    if update.message:
+        unique_id = media_unique_id(current_msg)
+        if unique_id:
+            # Stickers are shared widely by design, so they only count within a chat
+            flood_reason = media_flood.observe(chat.id, user.id, unique_id, count_global=not current_msg.sticker)
+            if flood_reason:
+                await handle_spam(flood_reason)
+                return
 
     if not text:
         if is_flood_spam(user.id):
             await handle_spam("flooding (media)")
         return
 
-    # Pass 'current_msg' so the spam check looks at the current version of the message
-    is_spam_message, reason = await is_spam(current_msg, text, entities, user.id, chat.id)
-    if is_spam_message:
-        await handle_spam(reason or "spam detected")
+    cache_key = (chat.id, current_msg.message_id)
+    fingerprint = message_fingerprint(text, entities)
+
+    async def check_message():
+        # Pass 'current_msg' so the spam check looks at the current version of the message
+        is_spam_message, reason = await is_spam(current_msg, text, entities, user.id, chat.id)
+        verdict_cache.store(cache_key, fingerprint)
+        if is_spam_message:
+            await handle_spam(reason or "spam detected")
+            return
+
+        if USERNAME_REQUIRED and not user.username:
+            await handle_spam("no username")
+            return
+
+    if update.edited_message:
+        # Edits that didn't change what the checks read are skipped; bursts are checked once, at the end
+        if not verdict_cache.unchanged(cache_key, fingerprint):
+            verdict_cache.debounce(cache_key, update, check_message)
         return
 
-    if USERNAME_REQUIRED and not user.username:
-        await handle_spam("no username")
+    await check_message()
+
+# ================= Update Narrowing =================
+
+def derive_allowed_updates(app: Application) -> frozenset:
+    """Collects the update types the registered handlers can consume."""
+    types = set()
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, (CommandHandler, MessageHandler)):
+                # Both default to new + edited messages; channel posts never pass our chat filters.
+                types.update((UpdateType.MESSAGE, UpdateType.EDITED_MESSAGE))
+            elif isinstance(handler, CallbackQueryHandler):
+                types.add(UpdateType.CALLBACK_QUERY)
+            elif isinstance(handler, ChatMemberHandler):
+                if handler.chat_member_types in (ChatMemberHandler.MY_CHAT_MEMBER, ChatMemberHandler.ANY_CHAT_MEMBER):
+                    types.add(UpdateType.MY_CHAT_MEMBER)
+                if handler.chat_member_types in (ChatMemberHandler.CHAT_MEMBER, ChatMemberHandler.ANY_CHAT_MEMBER):
+                    types.add(UpdateType.CHAT_MEMBER)
+            else:
+                # Unknown handler type: don't guess, ask Telegram for everything.
+                logger.warning(f"Cannot derive update types for {type(handler).__name__}; allowing all.")
+                return frozenset(Update.ALL_TYPES)
+    return frozenset(str(t) for t in types)
+
+def prefilter_raw_update(payload: Any) -> bool:
+    """
+    Cheap checks on the raw JSON dict. Returns False for updates no handler
+    would act on, so we skip building PTB objects for them.
+    """
+    if not isinstance(payload, dict):
+        return False
+    kind = next((k for k in payload if k != "update_id"), None)
+    if kind not in ALLOWED_UPDATES:
+        return False
+
+    if kind in ("message", "edited_message"):
+        msg = payload[kind]
+        chat_type = msg.get("chat", {}).get("type")
+        if chat_type not in HANDLED_CHAT_TYPES:
+            return False
+        # Private chats are only handled for text (commands, links)
+        if chat_type == "private" and "text" not in msg:
+            return False
+        if any(key in msg for key in IGNORED_SERVICE_KEYS):
+            return False
+    return True
+
+# ================= Webhook Ingest =================
+
+class UpdateDeduplicator:
+    """Bounded memory of recently accepted update_ids (set for lookups, deque for eviction order)."""
+    def __init__(self, window: int):
+        self._seen: set[int] = set()
+        self._order: deque = deque()
+        self.window = window
+        self.duplicates = 0
+        self._dirty = False
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def is_duplicate(self, update_id) -> bool:
+        if update_id in self._seen:
+            self.duplicates += 1
+            return True
+        return False
+
+    def mark(self, update_id: int):
+        self._seen.add(update_id)
+        self._order.append(update_id)
+        while len(self._order) > self.window:
+            self._seen.discard(self._order.popleft())
+        self._dirty = True
+
+    def load(self, update_ids: list[int]):
+        for update_id in update_ids[-self.window:]:
+            if update_id not in self._seen:
+                self.mark(update_id)
+        self._dirty = False
+
+    def snapshot(self) -> Optional[list[int]]:
+        """Returns the window if it changed since the last snapshot."""
+        if not self._dirty:
+            return None
+        self._dirty = False
+        return list(self._order)
+
+    def stats_lines(self) -> list[str]:
+        return [f"Duplicates dropped: {self.duplicates} | Window: {len(self)}/{self.window}"]
+
+update_dedup = UpdateDeduplicator(DEDUP_WINDOW)
+BOT_ID = int(TOKEN.split(":")[0]) if TOKEN and ":" in TOKEN else 0 # Persistence key; no getMe needed
+
+async def load_update_dedup():
+    if DEDUP_PERSIST:
+        update_dedup.load(await db.get_seen_updates(BOT_ID))
+        logger.info(f"Restored {len(update_dedup)} recent update_ids.")
+
+async def save_update_dedup(context: Optional[ContextTypes.DEFAULT_TYPE] = None):
+    snapshot = update_dedup.snapshot()
+    if DEDUP_PERSIST and snapshot is not None:
+        await db.save_seen_updates(BOT_ID, snapshot)
+
+async def ingest_update(payload: Any) -> tuple[int, str]:
+    """
+    Hands a decoded webhook payload to the application.
+    Shared by the native ASGI endpoint and the Flask compatibility route.
+    Returns (status_code, body).
+    """
+    if not payload:
+        return 200, "OK"
+    ingest_stats["received"] += 1
+    if not prefilter_raw_update(payload):
+        ingest_stats["prefiltered"] += 1
+        return 200, "OK"
+    update_id = payload.get("update_id")
+    if update_dedup.is_duplicate(update_id):
+        return 200, "OK" # Redelivery of an update we already queued
+    if not application.running:
+        logger.warning("Application not running, skipping update.")
+        return 503, "Application not running"
+    if ingest_queue.saturated():
+        ingest_queue.shed += 1
+        return UPDATE_QUEUE_SHED_STATUS, "Busy, retry later"
+    try:
+        update = Update.de_json(cast(dict, payload), application.bot)
+        if not ingest_queue.offer(update):
+            return UPDATE_QUEUE_SHED_STATUS, "Busy, retry later"
+        # Only accepted updates count as seen; shed ones must be retried by Telegram
+        update_dedup.mark(update.update_id)
+    except Exception as e:
+        logger.error(f"Error handling incoming update payload: {e}", exc_info=True)
+    return 200, "OK"
+
+# ================= Native ASGI App =================
+
+async def _asgi_respond(send, status: int, body: str):
+    data = body.encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"text/plain; charset=utf-8"),
+            (b"content-length", str(len(data)).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": data})
+
+async def _asgi_read_body(receive) -> Optional[bytes]:
+    """Reads the full request body, or returns None if it exceeds WEBHOOK_MAX_BODY."""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > WEBHOOK_MAX_BODY:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+async def _asgi_webhook(scope, receive) -> tuple[int, str]:
+    secret = None
+    for name, value in scope.get("headers", ()):
+        if name == b"x-telegram-bot-api-secret-token":
+            secret = value.decode("latin-1")
+            break
+    if secret != WEBHOOK_SECRET:
+        logger.warning("Received update with invalid secret token.")
+        return 403, "Unauthorized"
+
+    body = await _asgi_read_body(receive)
+    if body is None:
+        return 413, "Payload Too Large"
+    try:
+        payload = _json_loads(body) if body else None
+    except ValueError:
+        logger.warning("Received webhook body that is not valid JSON.")
+        return 400, "Bad Request"
+    return await ingest_update(payload)
+
+async def webhook_asgi_app(scope, receive, send):
+    """
+    Serves WEBHOOK_PATH, / and /ping directly on the event loop.
+    Updates are enqueued without the WSGI environ / Flask request / thread hop.
+    """
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
         return
 
-# ================= Flask Routes =================
+    path = scope["path"]
+    method = scope["method"]
+    if path == WEBHOOK_PATH:
+        if method != "POST":
+            status, body = 405, "Method Not Allowed"
+        else:
+            status, body = await _asgi_webhook(scope, receive)
+    elif path == "/" and method in ("GET", "HEAD"):
+        status, body = 200, "Bot is alive ✅"
+    elif path == "/ping" and method in ("GET", "HEAD"):
+        status, body = 200, "OK"
+    else:
+        status, body = 404, "Not Found"
+    await _asgi_respond(send, status, body)
+
+# ================= Flask Routes (Compatibility Mode) =================
 
 @app.route("/", methods=["GET"])
 def home():
@@ -1989,16 +4183,22 @@ def telegram_webhook():
         logger.warning("Received update with invalid secret token.")
         return "Unauthorized", 403
 
-    if request.json:
-        if not application.running:
-            logger.warning("Application not running, skipping update.")
-            return "Application not running", 503
-        try:
-            update = Update.de_json(cast(dict, request.json), application.bot)
-            application.update_queue.put_nowait(update) 
-        except Exception as e:
-            logger.error(f"Error handling incoming update payload: {e}", exc_info=True)
-    return "OK"
+    # This view runs on a worker thread; hop back onto the bot's loop to enqueue.
+    future = asyncio.run_coroutine_threadsafe(ingest_update(request.json), MAIN_LOOP)
+    try:
+        status, body = future.result(timeout=WEBHOOK_FLASK_TIMEOUT)
+    except TimeoutError: # concurrent.futures.TimeoutError is the builtin since 3.11
+        future.cancel()
+        logger.error("Timed out handing a webhook update to the bot loop.")
+        return "Timeout", 503
+    return body, status
+
+def build_asgi_app():
+    """Returns the ASGI app selected by WEBHOOK_SERVER."""
+    if WEBHOOK_SERVER == "flask":
+        logger.info("Serving webhook through Flask compatibility mode.")
+        return WsgiToAsgi(app)
+    return webhook_asgi_app
 
 # ================= Run Bot Server =================
 
@@ -2006,6 +4206,13 @@ async def setup_bot_application():
     global ML_MODEL, TFIDF_VECTORIZER
     
     await db.setup_database() 
+    await db.warm_pool() # Before the webhook is registered, so the first updates don't pay for connects
+    await media_registry.load()
+    await load_update_dedup()
+    try:
+        await blocklist.refresh(full=True)
+    except db.DatabaseUnavailable as e:
+        logger.warning(f"Blocklist not loaded at startup, the refresh job will retry: {e}")
 
     try:
         TFIDF_VECTORIZER, ML_MODEL = await asyncio.to_thread(_load_ml_model_sync, 'models/vectorizer.joblib', 'models/model.joblib')
@@ -2030,47 +4237,30 @@ async def setup_bot_application():
     application.add_handler(CommandHandler("rscore", rscore_command))
     application.add_handler(CommandHandler("mcount", mcount_command))
     application.add_handler(CommandHandler("toprep", toprep_command))
+    application.add_handler(CommandHandler("top", top_command, filters=filters.ChatType.GROUPS))
     application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(CommandHandler("addfeed", add_feed_command))
     application.add_handler(CommandHandler("removefeed", remove_feed_command))
     application.job_queue.run_repeating(check_rss_feeds, interval=1800, first=60)
     
     # LOAD SAVED SCHEDULES
-    rows = await db.get_all_announcements()
-    for row in rows:
-        try:
-            ann_id, c_id, txt, typ, val = row['id'], row['chat_id'], row['text'], row['type'], row['time_val']
-            if typ == "daily":
-                h, m = map(int, val.split(':'))
-                application.job_queue.run_daily(execute_announcement, dt_time(hour=h, minute=m), chat_id=c_id, data=txt, name=f"ann_{ann_id}")
-            elif typ == "every":
-                unit = val[-1].lower()
-                v = int(val[:-1])
-                secs = v * 60 if unit == 'm' else v * 3600
-                application.job_queue.run_repeating(execute_announcement, interval=secs, chat_id=c_id, data=txt, name=f"ann_{ann_id}")
-            # --- ADD THIS BLOCK ---
-            elif typ == "once":
-                # For 'once', we need to check if it's still valid or just run it on delay
-                unit = val[-1].lower()
-                v = int(val[:-1])
-                secs = v * 60 if unit == 'm' else v * 3600
-                # Note: This resets the timer on restart. 
-                # For exact precision, you'd need to save the target timestamp in DB, not just "30m"
-                application.job_queue.run_once(execute_announcement, when=secs, chat_id=c_id, data=txt, name=f"ann_{ann_id}")
-            # ----------------------
-        except Exception: pass
+    await restore_announcements(application.job_queue)
     
     application.add_handler(CommandHandler("mute", mute_user, filters=filters.ChatType.GROUPS))
     application.add_handler(CommandHandler("unmute", unmute_user_command, filters=filters.ChatType.GROUPS)) 
     application.add_handler(CommandHandler("ban", ban_user, filters=filters.ChatType.GROUPS))
     application.add_handler(CommandHandler("unban", unban_user_command, filters=filters.ChatType.GROUPS)) 
+    application.add_handler(CommandHandler("purge", purge_command, filters=filters.ChatType.GROUPS))
     # FIND THIS LINE:
     # application.add_handler(CommandHandler("warn", warn_user_command, filters=filters.ChatType.GROUPS))
     # REPLACE IT WITH THIS (Removes the Group filter):
     application.add_handler(CommandHandler("warn", warn_user_command))
     application.add_handler(CommandHandler("set_strict_mode", set_strict_mode, filters=filters.ChatType.GROUPS)) 
     application.add_handler(CommandHandler("set_ml_check", set_ml_check, filters=filters.ChatType.GROUPS)) 
-    application.add_handler(CommandHandler("set_reaction_mode", set_reaction_mode, filters=filters.ChatType.GROUPS)) 
+    application.add_handler(CommandHandler("set_reaction_mode", set_reaction_mode, filters=filters.ChatType.GROUPS))
+    application.add_handler(CommandHandler("set_blocklist", set_blocklist, filters=filters.ChatType.GROUPS))
+    application.add_handler(CommandHandler("unblock", unblock_command)) 
     application.add_handler(CommandHandler("check_permissions", check_permissions, filters=filters.ChatType.GROUPS))
     
     # --- NEW LINK COMMANDS ---
@@ -2084,6 +4274,9 @@ async def setup_bot_application():
     # REPLACE WITH THIS:
     application.add_handler(CallbackQueryHandler(button, pattern="^(done|ntf_sel_.*|cancel_warn:.*|unmute:.*|unban:.*|rep_.*)$")) 
     
+    # --- HANDLER FOR MEMBER CHANGES (admin promotions/demotions, gated channel leaves) ---
+    application.add_handler(ChatMemberHandler(chat_member_handler, ChatMemberHandler.CHAT_MEMBER))
+
     # --- HANDLER FOR PRIVATE REACTIONS ---
     application.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.TEXT, handle_private_reaction))
 
@@ -2093,8 +4286,18 @@ async def setup_bot_application():
         message_handler
     ))
     
+    application.add_error_handler(error_handler)
+
     application.job_queue.run_repeating(periodic_cleanup_job, interval=3600, first=5)
+    application.job_queue.run_repeating(flush_author_index_job, interval=AUTHOR_FLUSH_INTERVAL, first=AUTHOR_FLUSH_INTERVAL)
+    application.job_queue.run_repeating(refresh_blocklist_job, interval=BLOCKLIST_REFRESH_INTERVAL, first=BLOCKLIST_REFRESH_INTERVAL)
+    if DEDUP_PERSIST:
+        application.job_queue.run_repeating(save_update_dedup, interval=DEDUP_SAVE_INTERVAL, first=DEDUP_SAVE_INTERVAL)
     logger.info("Scheduled periodic warning cleanup job.")
+
+    global ALLOWED_UPDATES
+    ALLOWED_UPDATES = derive_allowed_updates(application)
+    logger.info(f"Allowed updates: {', '.join(sorted(ALLOWED_UPDATES))}")
     
     await application.initialize()
     await application.start()
@@ -2108,7 +4311,7 @@ async def setup_webhook():
     try:
         await application.bot.set_webhook(
             url=full_url, 
-            allowed_updates=Update.ALL_TYPES,
+            allowed_updates=sorted(ALLOWED_UPDATES),
             secret_token=WEBHOOK_SECRET
         )
         logger.info("Webhook set successfully.")
@@ -2120,17 +4323,18 @@ async def setup_webhook():
 async def serve_app():
     config = Config()
     config.bind = [f"0.0.0.0:{PORT}"]
-    asgi_app = WsgiToAsgi(app)
-    await serve(asgi_app, config)
+    await serve(build_asgi_app(), config)
     
 async def run_bot_server():
     """Main function to setup bot and start the web server."""
+    global MAIN_LOOP
+    MAIN_LOOP = asyncio.get_running_loop()
     await setup_bot_application()
     
     # 1. Define the server config
     config = Config()
     config.bind = [f"0.0.0.0:{PORT}"]
-    asgi_app = WsgiToAsgi(app)
+    asgi_app = build_asgi_app()
 
     # 2. Define a background task to set the webhook LATER
     async def set_webhook_delayed():
@@ -2147,6 +4351,8 @@ async def run_bot_server():
     finally:
         logger.info("Shutting down application...")
         await application.stop()
+        await author_index.flush() # Don't lose the last few seconds of index writes
+        await save_update_dedup()
         if db.db_pool:
             logger.info("Closing database pool...")
             await db.db_pool.close()
@@ -1,37 +1,343 @@
 import os
+import time
 import logging
+import asyncio
 import asyncpg
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta, timezone
 from asyncio import Lock
+from metrics import LatencyHistogram
 
 # Get the database URL from the environment variable
 DATABASE_URL = os.environ.get("DATABASE_URL")
 if not DATABASE_URL:
     logging.critical("FATAL: DATABASE_URL environment variable not set.")
 
-# Global connection pool and lock
+# Pool settings (override via environment)
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", 10))
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", 100)) # 0 behind pgbouncer (transaction mode)
+DB_COMMAND_TIMEOUT = float(os.environ.get("DB_COMMAND_TIMEOUT", 10))
+DB_ACQUIRE_TIMEOUT = float(os.environ.get("DB_ACQUIRE_TIMEOUT", 5))
+DB_MAX_INACTIVE_LIFETIME = float(os.environ.get("DB_MAX_INACTIVE_LIFETIME", 300))
+DB_SLOW_QUERY_MS = float(os.environ.get("DB_SLOW_QUERY_MS", 200))
+
+# Circuit breaker: after this many consecutive timeouts/connection errors, calls fail
+# fast (DatabaseUnavailable) for the cooldown, then a single probe is let through.
+DB_BREAKER_THRESHOLD = int(os.environ.get("DB_BREAKER_THRESHOLD", 5))
+DB_BREAKER_COOLDOWN = float(os.environ.get("DB_BREAKER_COOLDOWN", 30))
+# Timeouts are only blamed on the database when the caller had at least this much budget left
+DB_BREAKER_MIN_BUDGET = 0.5
+
+# Expired warnings are deleted in chunks of this size (one short transaction each)
+WARNING_SWEEP_BATCH = 1000
+
+# Global connection pool and locks
 db_pool = None
 _db_lock = Lock()
+_pool_lock = Lock() # Guards pool creation so concurrent first callers share one pool
+
+# Per-function latency histograms: time waiting in pool.acquire() and time holding the connection
+acquire_wait: dict[str, LatencyHistogram] = {}
+query_latency: dict[str, LatencyHistogram] = {}
+
+# Absolute deadline (event loop time) for DB work done on behalf of the current update.
+# Set by the bot per update; contextvars keep it local to that update's task.
+update_deadline: ContextVar[float | None] = ContextVar("update_deadline", default=None)
+
+class DatabaseUnavailable(Exception):
+    """The database timed out, is unreachable, or the breaker is open. Callers may fail open."""
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trips = 0
+        self.rejected = 0
+
+    @property
+    def degraded(self) -> bool:
+        """True from the trip until a call succeeds again."""
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < self.cooldown:
+            self.rejected += 1
+            return False
+        self.opened_at = now # Half-open: this call is the probe; others wait another cooldown
+        return True
+
+    def success(self):
+        if self.opened_at is not None:
+            logging.warning("Database circuit breaker closed: database is responding again.")
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self, name: str, error: BaseException):
+        self.failures += 1
+        if self.opened_at is not None:
+            self.opened_at = time.monotonic() # Probe failed, stay open
+        elif self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+            self.trips += 1
+            logging.error(
+                f"Database circuit breaker OPEN after {self.failures} consecutive failures "
+                f"(last in {name}: {error!r}); failing fast for {self.cooldown:.0f}s."
+            )
+
+breaker = CircuitBreaker(DB_BREAKER_THRESHOLD, DB_BREAKER_COOLDOWN)
+
+# Errors that say "the database is slow or gone", as opposed to a bad query
+_UNAVAILABLE_ERRORS = (
+    TimeoutError, OSError, asyncpg.PostgresConnectionError,
+    asyncpg.ConnectionDoesNotExistError, asyncpg.CannotConnectNowError,
+)
 
 async def get_pool():
     """Initializes and returns the database connection pool."""
     global db_pool
-    if db_pool is None:
-        try:
-            db_pool = await asyncpg.create_pool(
-                DATABASE_URL, 
-                command_timeout=10,
-                max_inactive_connection_lifetime=300
-            )
-            logging.info("Database connection pool created successfully.")
-        except Exception as e:
-            logging.error(f"Failed to create database pool: {e}")
-            return None
+    if db_pool is not None:
+        return db_pool
+    if not breaker.allow():
+        return None
+    async with _pool_lock:
+        if db_pool is None:
+            try:
+                db_pool = await asyncpg.create_pool(
+                    DATABASE_URL,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+                    command_timeout=DB_COMMAND_TIMEOUT,
+                    max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME
+                )
+                logging.info(f"Database connection pool created (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE}).")
+                breaker.success()
+            except Exception as e:
+                logging.error(f"Failed to create database pool: {e}")
+                breaker.failure("get_pool", e)
+                return None
     return db_pool
 
+@asynccontextmanager
+async def _acquire(pool, name: str):
+    """
+    pool.acquire() that records acquire-wait and query time under `name` and logs slow queries.
+    Honours the current update's deadline and the circuit breaker; slow or
+    unreachable databases surface as DatabaseUnavailable.
+    """
+    if not breaker.allow():
+        raise DatabaseUnavailable(f"{name}: circuit open")
+    deadline = update_deadline.get()
+    budget = None
+    if deadline is not None:
+        budget = deadline - asyncio.get_running_loop().time()
+        if budget <= 0:
+            raise DatabaseUnavailable(f"{name}: update deadline exceeded")
+
+    started = time.perf_counter()
+    try:
+        async with asyncio.timeout_at(deadline):
+            async with pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as conn:
+                acquired = time.perf_counter()
+                waited = acquired - started
+                acquire_wait.setdefault(name, LatencyHistogram()).observe(waited)
+                try:
+                    yield conn
+                finally:
+                    elapsed = time.perf_counter() - acquired
+                    query_latency.setdefault(name, LatencyHistogram()).observe(elapsed)
+                    if elapsed * 1000 >= DB_SLOW_QUERY_MS:
+                        logging.warning(f"Slow query in {name}: {elapsed * 1000:.0f}ms (waited {waited * 1000:.0f}ms for a connection)")
+    except _UNAVAILABLE_ERRORS as e:
+        if not (isinstance(e, TimeoutError) and budget is not None and budget < DB_BREAKER_MIN_BUDGET):
+            breaker.failure(name, e)
+        raise DatabaseUnavailable(f"{name}: {e!r}") from e
+    breaker.success()
+
+async def warm_pool():
+    """Opens and checks the minimum number of connections before traffic arrives."""
+    pool = await get_pool()
+    if not pool: return
+
+    async def _ping():
+        async with _acquire(pool, "warm_pool") as conn:
+            await conn.execute("SELECT 1")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(_ping() for _ in range(max(DB_POOL_MIN_SIZE, 1))))
+    logging.info(f"Database pool warmed: {pool.get_size()} connections in {(time.perf_counter() - started) * 1000:.0f}ms.")
+
+def pool_stats_lines() -> list[str]:
+    """Pool occupancy plus the busiest functions' acquire-wait and query histograms."""
+    state = "OPEN" if breaker.degraded else "closed"
+    breaker_line = f"Breaker: {state} | trips {breaker.trips} | fast-failed {breaker.rejected}"
+    if not db_pool:
+        return ["Pool: not created", breaker_line]
+    lines = [f"Pool: {db_pool.get_size()} open, {db_pool.get_idle_size()} idle (min {DB_POOL_MIN_SIZE}, max {DB_POOL_MAX_SIZE})", breaker_line]
+    busiest = sorted(query_latency.items(), key=lambda kv: kv[1].total, reverse=True)[:8]
+    for name, hist in busiest:
+        lines.append(f"• {name}: query {hist.summary()} | wait {acquire_wait[name].summary()}")
+    return lines
+
+# ================= SCHEMA MIGRATIONS =================
+# Each migration runs once, in order, and is recorded in schema_version.
+# Never edit a migration that has shipped; append a new one instead.
+MIGRATIONS: list[tuple[int, str, list[str]]] = [
+    (1, "base tables", [
+        """
+        CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id BIGINT PRIMARY KEY,
+            strict_mode BOOLEAN DEFAULT FALSE,
+            ml_mode BOOLEAN DEFAULT FALSE,
+            auto_reaction BOOLEAN DEFAULT FALSE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS warnings (
+            chat_id BIGINT,
+            user_id BIGINT,
+            count INTEGER DEFAULT 0,
+            expiry TIMESTAMPTZ,
+            PRIMARY KEY (chat_id, user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_activity (
+            chat_id BIGINT,
+            user_id BIGINT,
+            initial_count INTEGER DEFAULT 0,
+            total_messages INTEGER DEFAULT 0,
+            PRIMARY KEY (chat_id, user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS announcements (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT,
+            text TEXT,
+            type TEXT,
+            time_val TEXT,
+            last_run TIMESTAMPTZ DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS rss_feeds (
+            id SERIAL PRIMARY KEY,
+            feed_url TEXT UNIQUE,
+            last_entry_id TEXT,
+            target_chat_id BIGINT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS reputation (
+            user_id BIGINT PRIMARY KEY,
+            points INTEGER DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS bot_users (
+            user_id BIGINT PRIMARY KEY,
+            first_seen TIMESTAMPTZ DEFAULT NOW()
+        )
+        """,
+        # Columns added after the first release (for databases created before them)
+        "ALTER TABLE chat_settings ADD COLUMN IF NOT EXISTS auto_reaction BOOLEAN DEFAULT FALSE",
+        "ALTER TABLE user_activity ADD COLUMN IF NOT EXISTS total_messages INTEGER DEFAULT 0",
+    ]),
+    (2, "admin cache and media registry", [
+        """
+        CREATE TABLE IF NOT EXISTS chat_admins (
+            chat_id BIGINT PRIMARY KEY,
+            admin_ids BIGINT[] NOT NULL,
+            refreshed_at TIMESTAMPTZ DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS media_files (
+            asset TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            updated_at TIMESTAMPTZ DEFAULT NOW()
+        )
+        """,
+    ]),
+    (3, "secondary indexes", [
+        "CREATE INDEX IF NOT EXISTS warnings_expiry_idx ON warnings (expiry)",                       # expiry sweep
+        "CREATE INDEX IF NOT EXISTS reputation_points_idx ON reputation (points DESC)",              # get_top_reputation
+        "CREATE INDEX IF NOT EXISTS announcements_chat_idx ON announcements (chat_id)",              # per-chat listing
+        "CREATE INDEX IF NOT EXISTS rss_feeds_target_chat_idx ON rss_feeds (target_chat_id)",        # remove_rss_feed
+    ]),
+    (4, "activity leaderboard index", [
+        "CREATE INDEX IF NOT EXISTS user_activity_chat_total_idx ON user_activity (chat_id, total_messages DESC)",
+    ]),
+    (5, "absolute announcement schedule", [
+        "ALTER TABLE announcements ADD COLUMN IF NOT EXISTS next_run_at TIMESTAMPTZ",
+    ]),
+    (6, "message author index", [
+        """
+        CREATE TABLE IF NOT EXISTS message_authors (
+            chat_id BIGINT NOT NULL,
+            message_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            first_name TEXT,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            PRIMARY KEY (chat_id, message_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS message_authors_created_idx ON message_authors (created_at)",   # retention sweep
+    ]),
+    (7, "webhook update de-duplication window", [
+        """
+        CREATE TABLE IF NOT EXISTS seen_updates (
+            bot_id BIGINT PRIMARY KEY,
+            update_ids BIGINT[] NOT NULL,
+            saved_at TIMESTAMPTZ DEFAULT NOW()
+        )
+        """,
+    ]),
+    (8, "cross-chat spammer blocklist", [
+        """
+        CREATE TABLE IF NOT EXISTS spam_blocklist (
+            user_id BIGINT PRIMARY KEY,
+            source_chat_id BIGINT,
+            reason TEXT,
+            added_at TIMESTAMPTZ DEFAULT NOW()
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS spam_blocklist_added_idx ON spam_blocklist (added_at)",          # incremental refresh
+        "ALTER TABLE chat_settings ADD COLUMN IF NOT EXISTS use_blocklist BOOLEAN DEFAULT FALSE",
+    ]),
+    (9, "per-chat blocklist exemptions", [
+        """
+        CREATE TABLE IF NOT EXISTS spam_blocklist_exemptions (
+            chat_id BIGINT,
+            user_id BIGINT,
+            PRIMARY KEY (chat_id, user_id)
+        )
+        """,
+    ]),
+]
+
+# Held (transaction-scoped) while migrating so only one instance applies DDL
+MIGRATION_LOCK_KEY = 0x6D79626F74
+
+async def _schema_version(conn) -> int:
+    try:
+        return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    except asyncpg.exceptions.UndefinedTableError:
+        return 0
+
 async def setup_database():
     """
-    Runs on bot startup to create all necessary tables.
+    Runs on bot startup. Applies pending migrations; when the schema is
+    already current this is a single SELECT and no DDL runs.
     """
     async with _db_lock:
         pool = await get_pool()
@@ -39,115 +345,66 @@ async def setup_database():
             logging.error("Cannot set up database, pool is not available.")
             return
 
-        async with pool.acquire() as conn:
+        latest = MIGRATIONS[-1][0]
+        async with _acquire(pool, "setup_database") as conn:
             try:
-                # 1. Chat Settings Table
-                await conn.execute("""
-                    CREATE TABLE IF NOT EXISTS chat_settings (
-                        chat_id BIGINT PRIMARY KEY,
-                        strict_mode BOOLEAN DEFAULT FALSE,
-                        ml_mode BOOLEAN DEFAULT FALSE,
-                        auto_reaction BOOLEAN DEFAULT FALSE
-                    )
-                """)
-                
-                # 2. Warnings Table
-                await conn.execute("""
-                    CREATE TABLE IF NOT EXISTS warnings (
-                        chat_id BIGINT,
-                        user_id BIGINT,
-                        count INTEGER DEFAULT 0,
-                        expiry TIMESTAMPTZ,
-                        PRIMARY KEY (chat_id, user_id)
-                    )
-                """)
-                
-                # 3. User Activity Table (Tracks initial counts & total messages)
-                await conn.execute("""
-                    CREATE TABLE IF NOT EXISTS user_activity (
-                        chat_id BIGINT,
-                        user_id BIGINT,
-                        initial_count INTEGER DEFAULT 0,
-                        total_messages INTEGER DEFAULT 0,
-                        PRIMARY KEY (chat_id, user_id)
-                    )
-                """)
-                
-                # 4. Announcements Table
-                await conn.execute("""
-                    CREATE TABLE IF NOT EXISTS announcements (
-                        id SERIAL PRIMARY KEY,
-                        chat_id BIGINT,
-                        text TEXT,
-                        type TEXT,
-                        time_val TEXT,
-                        last_run TIMESTAMPTZ DEFAULT NOW()
-                    )
-                """)
-
-                # 5. RSS Feeds Table (NEW)
-                await conn.execute("""
-                    CREATE TABLE IF NOT EXISTS rss_feeds (
-                        id SERIAL PRIMARY KEY,
-                        feed_url TEXT UNIQUE,
-                        last_entry_id TEXT,
-                        target_chat_id BIGINT
-                    )
-                """)
-                
-                # 6. Reputation Table (NEW)
-                await conn.execute("""
-                    CREATE TABLE IF NOT EXISTS reputation (
-                        user_id BIGINT PRIMARY KEY,
-                        points INTEGER DEFAULT 0
-                    )
-                """)
-
-                # 7. Bot Users Table (NEW - For Broadcast)
-                await conn.execute("""
-                    CREATE TABLE IF NOT EXISTS bot_users (
-                        user_id BIGINT PRIMARY KEY,
-                        first_seen TIMESTAMPTZ DEFAULT NOW()
-                    )
-                """)
-                
-                logging.info("Database tables verified/created.")
-                
-                # --- SCHEMA MIGRATIONS (For existing databases) ---
-                try:
-                    await conn.execute("ALTER TABLE chat_settings ADD COLUMN IF NOT EXISTS auto_reaction BOOLEAN DEFAULT FALSE")
-                    logging.info("Verified 'auto_reaction' column.")
-                except Exception: pass
-                
-                try:
-                    await conn.execute("ALTER TABLE user_activity ADD COLUMN IF NOT EXISTS total_messages INTEGER DEFAULT 0")
-                    logging.info("Verified 'total_messages' column.")
-                except Exception: pass
-                
+                current = await _schema_version(conn)
+                if current >= latest:
+                    logging.info(f"Database schema is current (version {current}).")
+                    return
+
+                for version, description, statements in MIGRATIONS:
+                    if version <= current:
+                        continue
+                    async with conn.transaction():
+                        await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK_KEY)
+                        await conn.execute("""
+                            CREATE TABLE IF NOT EXISTS schema_version (
+                                version INTEGER PRIMARY KEY,
+                                description TEXT,
+                                applied_at TIMESTAMPTZ DEFAULT NOW()
+                            )
+                        """)
+                        # Another instance may have applied it while we waited for the lock
+                        if await _schema_version(conn) >= version:
+                            continue
+                        for statement in statements:
+                            await conn.execute(statement)
+                        await conn.execute(
+                            "INSERT INTO schema_version (version, description) VALUES ($1, $2)",
+                            version, description
+                        )
+                    logging.info(f"Applied schema migration {version}: {description}")
             except Exception as e:
-                logging.error(f"Error setting up database tables: {e}")
+                logging.error(f"Error migrating database schema: {e}")
 
 # ================= CHAT SETTINGS =================
 
+DEFAULT_CHAT_SETTINGS = {"strict_mode": False, "ml_mode": False, "auto_reaction": False, "use_blocklist": False}
+CHAT_SETTING_NAMES = tuple(DEFAULT_CHAT_SETTINGS)
+_settings_cache: dict[int, dict] = {} # Last values read; served while the database is unavailable
+
 async def get_chat_settings(chat_id: int) -> dict:
     pool = await get_pool()
     if not pool:
-        return {"strict_mode": False, "ml_mode": False, "auto_reaction": False} 
+        return dict(_settings_cache.get(chat_id, DEFAULT_CHAT_SETTINGS))
 
-    async with pool.acquire() as conn:
-        try:
-            row = await conn.fetchrow(
-                "SELECT strict_mode, ml_mode, auto_reaction FROM chat_settings WHERE chat_id = $1",
-                chat_id
-            )
-        except asyncpg.exceptions.UndefinedColumnError:
-            row = await conn.fetchrow(
-                 "SELECT strict_mode, ml_mode, FALSE as auto_reaction FROM chat_settings WHERE chat_id = $1",
-                chat_id
-            )
+    try:
+        settings = await _fetch_chat_settings(pool, chat_id)
+    except DatabaseUnavailable:
+        return dict(_settings_cache.get(chat_id, DEFAULT_CHAT_SETTINGS))
+    _settings_cache[chat_id] = settings
+    return dict(settings)
+
+async def _fetch_chat_settings(pool, chat_id: int) -> dict:
+    async with _acquire(pool, "get_chat_settings") as conn:
+        row = await conn.fetchrow(
+            "SELECT strict_mode, ml_mode, auto_reaction, use_blocklist FROM chat_settings WHERE chat_id = $1",
+            chat_id
+        )
 
         if row:
-            return {"strict_mode": row['strict_mode'], "ml_mode": row['ml_mode'], "auto_reaction": row['auto_reaction']}
+            return {name: bool(row[name]) for name in CHAT_SETTING_NAMES}
         
         try:
             await conn.execute(
@@ -161,11 +418,11 @@ async def get_chat_settings(chat_id: int) -> dict:
         except Exception as e:
              logging.warning(f"Failed to insert default chat_settings for {chat_id}: {e}")
             
-        return {"strict_mode": False, "ml_mode": False, "auto_reaction": False}
+        return dict(DEFAULT_CHAT_SETTINGS)
 
 async def set_chat_setting(chat_id: int, setting_name: str, value: bool):
     pool = await get_pool()
-    if not pool or setting_name not in ('strict_mode', 'ml_mode', 'auto_reaction'):
+    if not pool or setting_name not in CHAT_SETTING_NAMES:
         return
 
     query = f"""
@@ -174,51 +431,95 @@ async def set_chat_setting(chat_id: int, setting_name: str, value: bool):
         ON CONFLICT (chat_id) DO UPDATE
         SET {setting_name} = $2
     """
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "set_chat_setting") as conn:
         await conn.execute(query, chat_id, value)
+    _settings_cache.pop(chat_id, None)
+
+# ================= ADMIN CACHE =================
+
+async def get_chat_admins(chat_id: int) -> tuple[list[int] | None, datetime | None]:
+    """Returns the persisted admin list and when it was fetched, or (None, None)."""
+    pool = await get_pool()
+    if not pool: return None, None
+    async with _acquire(pool, "get_chat_admins") as conn:
+        row = await conn.fetchrow("SELECT admin_ids, refreshed_at FROM chat_admins WHERE chat_id = $1", chat_id)
+        if not row:
+            return None, None
+        return list(row['admin_ids']), row['refreshed_at']
+
+async def save_chat_admins(chat_id: int, admin_ids: list[int], refreshed: bool = True):
+    """Stores the admin list. Event-driven edits pass refreshed=False to keep the fetch time."""
+    pool = await get_pool()
+    if not pool: return
+    async with _acquire(pool, "save_chat_admins") as conn:
+        await conn.execute("""
+            INSERT INTO chat_admins (chat_id, admin_ids, refreshed_at) VALUES ($1, $2, NOW())
+            ON CONFLICT (chat_id) DO UPDATE
+            SET admin_ids = $2,
+                refreshed_at = CASE WHEN $3 THEN NOW() ELSE chat_admins.refreshed_at END
+        """, chat_id, admin_ids, refreshed)
+
+async def clear_chat_admins(chat_id: int):
+    pool = await get_pool()
+    if not pool: return
+    async with _acquire(pool, "clear_chat_admins") as conn:
+        await conn.execute("DELETE FROM chat_admins WHERE chat_id = $1", chat_id)
 
 # ================= WARNING SYSTEM =================
 
 async def add_warning_async(chat_id: int, user_id: int) -> tuple[int, datetime]:
     pool = await get_pool()
-    if not pool: raise Exception("No DB pool")
+    if not pool: raise DatabaseUnavailable("add_warning_async: no pool")
     
-    new_expiry = datetime.now(timezone.utc) + timedelta(days=1)
+    now = datetime.now(timezone.utc)
+    new_expiry = now + timedelta(days=1)
     
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "add_warning_async") as conn:
+        # A lapsed warning restarts the count at 1 even if the sweep hasn't removed it yet
         row = await conn.fetchrow(
             """
             INSERT INTO warnings (chat_id, user_id, count, expiry)
             VALUES ($1, $2, 1, $3)
             ON CONFLICT (chat_id, user_id) DO UPDATE
             SET
-                count = warnings.count + 1,
+                count = CASE WHEN warnings.expiry < $4 THEN 1 ELSE warnings.count + 1 END,
                 expiry = $3
             RETURNING count, expiry
             """,
-            chat_id, user_id, new_expiry
+            chat_id, user_id, new_expiry, now
         )
         return row['count'], row['expiry']
 
 async def clear_warning_async(chat_id: int, user_id: int):
     pool = await get_pool()
     if not pool: return
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "clear_warning_async") as conn:
         await conn.execute("DELETE FROM warnings WHERE chat_id = $1 AND user_id = $2", chat_id, user_id)
 
-async def clean_expired_warnings_async():
+async def clean_expired_warnings_async(batch_size: int = WARNING_SWEEP_BATCH) -> int:
+    """Deletes expired warnings in bounded batches (uses warnings_expiry_idx). Returns rows deleted."""
     pool = await get_pool()
-    if not pool: return
-    async with pool.acquire() as conn:
-        now = datetime.now(timezone.utc)
-        await conn.execute("DELETE FROM warnings WHERE expiry < $1", now)
+    if not pool: return 0
+    now = datetime.now(timezone.utc)
+    total = 0
+    while True:
+        async with _acquire(pool, "clean_expired_warnings_async") as conn:
+            status = await conn.execute("""
+                DELETE FROM warnings WHERE ctid = ANY(ARRAY(
+                    SELECT ctid FROM warnings WHERE expiry < $1 LIMIT $2
+                ))
+            """, now, batch_size)
+        deleted = int(status.split()[-1])
+        total += deleted
+        if deleted < batch_size:
+            return total
 
 # ================= USER ACTIVITY & RANKS =================
 
 async def get_user_initial_count(chat_id: int, user_id: int) -> int:
     pool = await get_pool()
     if not pool: return 0
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "get_user_initial_count") as conn:
         count = await conn.fetchval(
             "SELECT initial_count FROM user_activity WHERE chat_id = $1 AND user_id = $2",
             chat_id, user_id
@@ -228,7 +529,7 @@ async def get_user_initial_count(chat_id: int, user_id: int) -> int:
 async def increment_user_initial_count(chat_id: int, user_id: int, max_count: int):
     pool = await get_pool()
     if not pool: return
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "increment_user_initial_count") as conn:
         await conn.execute(
             """
             INSERT INTO user_activity (chat_id, user_id, initial_count)
@@ -240,22 +541,48 @@ async def increment_user_initial_count(chat_id: int, user_id: int, max_count: in
             chat_id, user_id, max_count
         )
 
-async def increment_total_messages(chat_id: int, user_id: int):
-    """Increments the total message count for a user (for Ranking)."""
+async def increment_total_messages(chat_id: int, user_id: int) -> int:
+    """Increments the total message count for a user (for Ranking). Returns the new count."""
     pool = await get_pool()
-    if not pool: return
-    async with pool.acquire() as conn:
-        await conn.execute("""
+    if not pool: return 0
+    async with _acquire(pool, "increment_total_messages") as conn:
+        return await conn.fetchval("""
             INSERT INTO user_activity (chat_id, user_id, total_messages) VALUES ($1, $2, 1)
             ON CONFLICT (chat_id, user_id) DO UPDATE 
             SET total_messages = user_activity.total_messages + 1
+            RETURNING total_messages
         """, chat_id, user_id)
 
+async def get_top_activity(chat_id: int, limit: int = 10):
+    """Most active users of a chat (walks user_activity_chat_total_idx)."""
+    pool = await get_pool()
+    if not pool: return []
+    async with _acquire(pool, "get_top_activity") as conn:
+        return await conn.fetch("""
+            SELECT user_id, total_messages FROM user_activity
+            WHERE chat_id = $1 ORDER BY total_messages DESC LIMIT $2
+        """, chat_id, limit)
+
+async def get_activity_rank(chat_id: int, user_id: int) -> tuple[int | None, int]:
+    """Returns (rank, total_messages) of a user in a chat; rank is None if they have no row."""
+    pool = await get_pool()
+    if not pool: return None, 0
+    async with _acquire(pool, "get_activity_rank") as conn:
+        row = await conn.fetchrow("""
+            SELECT a.total_messages,
+                   (SELECT COUNT(*) FROM user_activity b
+                    WHERE b.chat_id = $1 AND b.total_messages > a.total_messages) + 1 AS rank
+            FROM user_activity a WHERE a.chat_id = $1 AND a.user_id = $2
+        """, chat_id, user_id)
+        if not row:
+            return None, 0
+        return row['rank'], row['total_messages']
+
 async def get_user_rank_data(chat_id: int, user_id: int):
     """Fetches message count and reputation for the /info command."""
     pool = await get_pool()
     if not pool: return None, 0
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "get_user_rank_data") as conn:
         row = await conn.fetchrow("""
             SELECT total_messages, initial_count 
             FROM user_activity WHERE chat_id = $1 AND user_id = $2
@@ -266,40 +593,67 @@ async def get_user_rank_data(chat_id: int, user_id: int):
 
 # ================= ANNOUNCEMENT SCHEDULER =================
 
-async def add_announcement(chat_id: int, text: str, type_: str, time_val: str) -> int:
+async def add_announcement(chat_id: int, text: str, type_: str, time_val: str, next_run_at: datetime) -> int:
     pool = await get_pool()
     if not pool: return -1
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "add_announcement") as conn:
         row = await conn.fetchrow(
-            "INSERT INTO announcements (chat_id, text, type, time_val) VALUES ($1, $2, $3, $4) RETURNING id",
-            chat_id, text, type_, time_val
+            "INSERT INTO announcements (chat_id, text, type, time_val, next_run_at) VALUES ($1, $2, $3, $4, $5) RETURNING id",
+            chat_id, text, type_, time_val, next_run_at
         )
         return row['id']
 
+async def set_announcement_next_run(ann_id: int, next_run_at: datetime, ran: bool = True) -> bool:
+    """Stores the next absolute run time; ran=True also stamps last_run. False if the row is gone,
+    DatabaseUnavailable if we can't tell."""
+    pool = await get_pool()
+    if not pool: raise DatabaseUnavailable("set_announcement_next_run: no pool")
+    async with _acquire(pool, "set_announcement_next_run") as conn:
+        status = await conn.execute("""
+            UPDATE announcements
+            SET next_run_at = $2, last_run = CASE WHEN $3 THEN NOW() ELSE last_run END
+            WHERE id = $1
+        """, ann_id, next_run_at, ran)
+        return status != "UPDATE 0"
+
 async def remove_announcement(ann_id: int):
     pool = await get_pool()
     if not pool: return
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "remove_announcement") as conn:
         await conn.execute("DELETE FROM announcements WHERE id = $1", ann_id)
 
 async def get_all_announcements():
     pool = await get_pool()
     if not pool: return []
-    async with pool.acquire() as conn:
-        return await conn.fetch("SELECT * FROM announcements")
+    async with _acquire(pool, "get_all_announcements") as conn:
+        return await conn.fetch("SELECT * FROM announcements ORDER BY id")
+
+async def get_announcements_page(after_id: int, limit: int):
+    """Keyset page of announcements with id > after_id, for restoring jobs at startup."""
+    pool = await get_pool()
+    if not pool: return []
+    async with _acquire(pool, "get_announcements_page") as conn:
+        return await conn.fetch("SELECT * FROM announcements WHERE id > $1 ORDER BY id LIMIT $2", after_id, limit)
+
+async def get_chat_announcements(chat_id: int):
+    """Announcements of one chat (uses announcements_chat_idx)."""
+    pool = await get_pool()
+    if not pool: return []
+    async with _acquire(pool, "get_chat_announcements") as conn:
+        return await conn.fetch("SELECT * FROM announcements WHERE chat_id = $1 ORDER BY id", chat_id)
 
 # ================= RSS FEEDS (NEW) =================
 
 async def get_rss_feeds():
     pool = await get_pool()
     if not pool: return []
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "get_rss_feeds") as conn:
         return await conn.fetch("SELECT * FROM rss_feeds")
 
 async def add_rss_feed(url: str, chat_id: int):
     pool = await get_pool()
     if not pool: return
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "add_rss_feed") as conn:
         await conn.execute(
             "INSERT INTO rss_feeds (feed_url, target_chat_id) VALUES ($1, $2) ON CONFLICT (feed_url) DO NOTHING",
             url, chat_id
@@ -308,7 +662,7 @@ async def add_rss_feed(url: str, chat_id: int):
 async def remove_rss_feed(url: str, chat_id: int):
     pool = await get_pool()
     if not pool: return
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "remove_rss_feed") as conn:
         await conn.execute(
             "DELETE FROM rss_feeds WHERE feed_url = $1 AND target_chat_id = $2",
             url, chat_id
@@ -317,7 +671,7 @@ async def remove_rss_feed(url: str, chat_id: int):
 async def update_rss_last_entry(feed_id: int, entry_id: str):
     pool = await get_pool()
     if not pool: return
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "update_rss_last_entry") as conn:
         await conn.execute("UPDATE rss_feeds SET last_entry_id = $1 WHERE id = $2", entry_id, feed_id)
 
 # ================= REPUTATION SYSTEM (NEW) =================
@@ -325,7 +679,7 @@ async def update_rss_last_entry(feed_id: int, entry_id: str):
 async def add_reputation(user_id: int, points: int = 1):
     pool = await get_pool()
     if not pool: return
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "add_reputation") as conn:
         await conn.execute("""
             INSERT INTO reputation (user_id, points) VALUES ($1, $2)
             ON CONFLICT (user_id) DO UPDATE SET points = reputation.points + $2
@@ -334,30 +688,179 @@ async def add_reputation(user_id: int, points: int = 1):
 async def get_top_reputation(limit=10):
     pool = await get_pool()
     if not pool: return []
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "get_top_reputation") as conn:
         return await conn.fetch("SELECT user_id, points FROM reputation ORDER BY points DESC LIMIT $1", limit)
 
+# ================= MEDIA REGISTRY =================
+
+async def get_media_file(asset: str) -> tuple[str | None, str | None]:
+    """Returns (content_hash, file_id) stored for an asset, or (None, None)."""
+    pool = await get_pool()
+    if not pool: return None, None
+    async with _acquire(pool, "get_media_file") as conn:
+        row = await conn.fetchrow("SELECT content_hash, file_id FROM media_files WHERE asset = $1", asset)
+        return (row['content_hash'], row['file_id']) if row else (None, None)
+
+async def save_media_file(asset: str, content_hash: str, file_id: str):
+    pool = await get_pool()
+    if not pool: return
+    async with _acquire(pool, "save_media_file") as conn:
+        await conn.execute("""
+            INSERT INTO media_files (asset, content_hash, file_id) VALUES ($1, $2, $3)
+            ON CONFLICT (asset) DO UPDATE SET content_hash = $2, file_id = $3, updated_at = NOW()
+        """, asset, content_hash, file_id)
+
+# ================= SPAM BLOCKLIST =================
+
+async def add_to_blocklist(user_id: int, source_chat_id: int, reason: str):
+    pool = await get_pool()
+    if not pool: return
+    async with _acquire(pool, "add_to_blocklist") as conn:
+        await conn.execute("""
+            INSERT INTO spam_blocklist (user_id, source_chat_id, reason) VALUES ($1, $2, $3)
+            ON CONFLICT (user_id) DO NOTHING
+        """, user_id, source_chat_id, reason)
+
+async def remove_from_blocklist(user_id: int, source_chat_id: int | None = None) -> bool:
+    """Deletes the entry; with source_chat_id, only if that chat is the one that listed the user."""
+    pool = await get_pool()
+    if not pool: raise DatabaseUnavailable("remove_from_blocklist: no pool")
+    async with _acquire(pool, "remove_from_blocklist") as conn:
+        if source_chat_id is None:
+            status = await conn.execute("DELETE FROM spam_blocklist WHERE user_id = $1", user_id)
+        else:
+            status = await conn.execute(
+                "DELETE FROM spam_blocklist WHERE user_id = $1 AND source_chat_id = $2", user_id, source_chat_id
+            )
+        return status.endswith(" 1")
+
+async def add_blocklist_exemption(chat_id: int, user_id: int):
+    """An admin of chat_id cleared a user someone else listed: stop enforcing it there only."""
+    pool = await get_pool()
+    if not pool: raise DatabaseUnavailable("add_blocklist_exemption: no pool")
+    async with _acquire(pool, "add_blocklist_exemption") as conn:
+        await conn.execute("""
+            INSERT INTO spam_blocklist_exemptions (chat_id, user_id) VALUES ($1, $2)
+            ON CONFLICT DO NOTHING
+        """, chat_id, user_id)
+
+async def remove_blocklist_exemption(chat_id: int, user_id: int):
+    pool = await get_pool()
+    if not pool: raise DatabaseUnavailable("remove_blocklist_exemption: no pool")
+    async with _acquire(pool, "remove_blocklist_exemption") as conn:
+        await conn.execute(
+            "DELETE FROM spam_blocklist_exemptions WHERE chat_id = $1 AND user_id = $2", chat_id, user_id
+        )
+
+async def get_blocklist_exemptions() -> list[tuple[int, int]]:
+    pool = await get_pool()
+    if not pool: raise DatabaseUnavailable("get_blocklist_exemptions: no pool")
+    async with _acquire(pool, "get_blocklist_exemptions") as conn:
+        rows = await conn.fetch("SELECT chat_id, user_id FROM spam_blocklist_exemptions")
+        return [(r['chat_id'], r['user_id']) for r in rows]
+
+async def get_blocklist_since(since: datetime | None) -> tuple[list[int], datetime | None]:
+    """User ids added after `since` (all when None) and the newest added_at seen."""
+    pool = await get_pool()
+    if not pool: raise DatabaseUnavailable("get_blocklist_since: no pool")
+    async with _acquire(pool, "get_blocklist_since") as conn:
+        if since is None:
+            rows = await conn.fetch("SELECT user_id, added_at FROM spam_blocklist")
+        else:
+            rows = await conn.fetch("SELECT user_id, added_at FROM spam_blocklist WHERE added_at > $1", since)
+    newest = max((r['added_at'] for r in rows), default=since)
+    return [r['user_id'] for r in rows], newest
+
+async def get_blocklist_chats() -> list[int]:
+    """Chats that opted into the shared blocklist."""
+    pool = await get_pool()
+    if not pool: raise DatabaseUnavailable("get_blocklist_chats: no pool")
+    async with _acquire(pool, "get_blocklist_chats") as conn:
+        rows = await conn.fetch("SELECT chat_id FROM chat_settings WHERE use_blocklist")
+        return [r['chat_id'] for r in rows]
+
+# ================= MESSAGE AUTHORS =================
+
+async def save_message_authors(rows: list[tuple[int, int, int, str]]):
+    """Bulk-inserts (chat_id, message_id, user_id, first_name) rows in one statement."""
+    pool = await get_pool()
+    if not pool or not rows: return
+    chat_ids, message_ids, user_ids, names = (list(col) for col in zip(*rows))
+    async with _acquire(pool, "save_message_authors") as conn:
+        await conn.execute("""
+            INSERT INTO message_authors (chat_id, message_id, user_id, first_name)
+            SELECT * FROM unnest($1::BIGINT[], $2::BIGINT[], $3::BIGINT[], $4::TEXT[])
+            ON CONFLICT (chat_id, message_id) DO NOTHING
+        """, chat_ids, message_ids, user_ids, names)
+
+async def get_message_author(chat_id: int, message_id: int) -> tuple[int, str] | None:
+    """Returns (user_id, first_name) for an indexed message, or None."""
+    pool = await get_pool()
+    if not pool: return None
+    async with _acquire(pool, "get_message_author") as conn:
+        row = await conn.fetchrow(
+            "SELECT user_id, first_name FROM message_authors WHERE chat_id = $1 AND message_id = $2",
+            chat_id, message_id
+        )
+        return (row['user_id'], row['first_name']) if row else None
+
+async def clean_message_authors(retention_hours: int, batch_size: int = WARNING_SWEEP_BATCH) -> int:
+    """Drops index rows older than the retention window, in bounded batches. Returns rows deleted."""
+    pool = await get_pool()
+    if not pool: return 0
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=retention_hours)
+    total = 0
+    while True:
+        async with _acquire(pool, "clean_message_authors") as conn:
+            status = await conn.execute("""
+                DELETE FROM message_authors WHERE ctid = ANY(ARRAY(
+                    SELECT ctid FROM message_authors WHERE created_at < $1 LIMIT $2
+                ))
+            """, cutoff, batch_size)
+        deleted = int(status.split()[-1])
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+# ================= WEBHOOK DE-DUPLICATION =================
+
+async def get_seen_updates(bot_id: int) -> list[int]:
+    pool = await get_pool()
+    if not pool: return []
+    async with _acquire(pool, "get_seen_updates") as conn:
+        ids = await conn.fetchval("SELECT update_ids FROM seen_updates WHERE bot_id = $1", bot_id)
+        return list(ids) if ids else []
+
+async def save_seen_updates(bot_id: int, update_ids: list[int]):
+    pool = await get_pool()
+    if not pool: return
+    async with _acquire(pool, "save_seen_updates") as conn:
+        await conn.execute("""
+            INSERT INTO seen_updates (bot_id, update_ids) VALUES ($1, $2)
+            ON CONFLICT (bot_id) DO UPDATE SET update_ids = $2, saved_at = NOW()
+        """, bot_id, update_ids)
+
 # ================= BROADCAST / PRIVATE USERS (NEW) =================
 
 async def log_private_user(user_id: int):
     """Logs a user who has started the bot in private."""
     pool = await get_pool()
     if not pool: return
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "log_private_user") as conn:
         await conn.execute("INSERT INTO bot_users (user_id) VALUES ($1) ON CONFLICT (user_id) DO NOTHING", user_id)
 
 async def get_all_bot_users():
     """Fetches all users for broadcast."""
     pool = await get_pool()
     if not pool: return []
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "get_all_bot_users") as conn:
         return await conn.fetch("SELECT user_id FROM bot_users")
 # ================= ADMIN SETTERS (bottom) =================
 
 async def set_message_count(chat_id: int, user_id: int, count: int):
     """Manually sets the message count for a user in a specific group."""
     pool = await get_pool()
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "set_message_count") as conn:
         await conn.execute("""
             INSERT INTO user_activity (chat_id, user_id, total_messages) VALUES ($1, $2, $3)
             ON CONFLICT (chat_id, user_id) DO UPDATE SET total_messages = $3
@@ -366,7 +869,7 @@ async def set_message_count(chat_id: int, user_id: int, count: int):
 async def set_reputation(user_id: int, points: int):
     """Manually sets the reputation points for a user."""
     pool = await get_pool()
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "set_reputation") as conn:
         await conn.execute("""
             INSERT INTO reputation (user_id, points) VALUES ($1, $2)
             ON CONFLICT (user_id) DO UPDATE SET points = $2
@@ -0,0 +1,44 @@
+"""Small in-process latency histograms, reported through /stats."""
+import bisect
+
+# Bucket upper bounds in milliseconds; the last bucket is open-ended.
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram. observe() takes seconds."""
+    __slots__ = ("counts", "total", "sum_ms", "max_ms")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.total = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, seconds: float):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.total += 1
+        self.sum_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def percentile(self, p: float) -> float:
+        """Upper bound (ms) of the bucket holding the p-th percentile."""
+        if not self.total:
+            return 0.0
+        rank = self.total * p / 100
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return BUCKETS_MS[i] if i < len(BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def summary(self) -> str:
+        if not self.total:
+            return "n=0"
+        return (
+            f"n={self.total} avg={self.sum_ms / self.total:.1f}ms "
+            f"p50≤{self.percentile(50):g}ms p99≤{self.percentile(99):g}ms max={self.max_ms:.0f}ms"
+        )